@@ -0,0 +1,58 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "numpy"
+# ]
+# ///
+
+# Checks that chip_buffer never hands out a shared memory block /dev/shm cannot hold (writing one would SIGBUS),
+# using a simulated 64mb /dev/shm like docker's default.
+
+import os
+import errno
+import pickle
+
+import chip_buffer
+
+CHIP_SHAPE = (2816, 2816, 3)
+CHIP_BYTES = CHIP_SHAPE[0] * CHIP_SHAPE[1] * CHIP_SHAPE[2]
+
+if hasattr(os, 'posix_fallocate') and os.path.isdir(chip_buffer.SHM_PATH):
+    # Pages are reserved when the block is created, not when it is first written
+    free_before = os.statvfs(chip_buffer.SHM_PATH).f_bavail * os.statvfs(chip_buffer.SHM_PATH).f_frsize
+    chip = chip_buffer.SharedChip(CHIP_SHAPE)
+    free_after = os.statvfs(chip_buffer.SHM_PATH).f_bavail * os.statvfs(chip_buffer.SHM_PATH).f_frsize
+    print(f'Creating a {CHIP_BYTES / (1024 * 1024):.1f}mb chip took {(free_before - free_after) / (1024 * 1024):.1f}mb of {chip_buffer.SHM_PATH}')
+    if chip.shm is not None:
+        assert free_before - free_after >= CHIP_BYTES
+    chip.free()
+
+    shm_free_bytes = [64 * 1024 * 1024]
+    real_posix_fallocate = os.posix_fallocate
+    def small_shm_posix_fallocate(fd, offset, length):
+        if length > shm_free_bytes[0]:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        shm_free_bytes[0] -= length
+        real_posix_fallocate(fd, offset, length)
+
+    os.posix_fallocate = small_shm_posix_fallocate
+    try:
+        ring = chip_buffer.ChipRing(8, CHIP_SHAPE)
+    finally:
+        os.posix_fallocate = real_posix_fallocate
+    shared = [chip for chip in ring.chips if chip.shm is not None]
+    print(f'A ring of {len(ring.chips)} chips in a 64mb {chip_buffer.SHM_PATH} put {len(shared)} in shared memory')
+    assert len(shared) == 2
+    assert all(chip.name is None for chip in ring.chips if chip.shm is None)
+    for chip in ring.chips:
+        chip.pixels[:] = 7
+
+    # Chips kept in process memory are copied when pickled, shared ones only pass their name
+    fallback = [chip for chip in ring.chips if chip.shm is None][0]
+    copied = pickle.loads(pickle.dumps(fallback))
+    assert copied.shm is None and copied.pixels.shape == CHIP_SHAPE and int(copied.pixels[100, 100, 0]) == 7
+    assert len(pickle.dumps(shared[0])) < 1024
+    ring.free()
+    print('chip_buffer checks passed')
+else:
+    print(f'No {chip_buffer.SHM_PATH} or posix_fallocate here, nothing to check')
@@ -0,0 +1,112 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "diskcache",
+#   "platformdirs",
+#   "Pillow",
+#   "shapely",
+#   "requests",
+#   "numpy"
+# ]
+# ///
+
+# Follows a synthetic straight line of towers with and without follow_predictive and checks that predicting the next
+# tower scans far fewer pixels and downloads far fewer tiles. Tiles are rendered locally (towers are white squares on
+# a gray background) and a stand-in model finds the squares, so nothing is downloaded and no model file is needed.
+
+import io
+import tempfile
+
+import numpy
+from PIL import Image
+
+import so_funcs
+import projection
+import tile_store
+import location_chipper
+import tower_follower
+
+START_LONX, START_LATY = -110.0, 31.0
+NUM_TOWERS = 40
+SPAN_M = 300.0
+BEARING_DEG = 80.0
+TOWER_PX = 12
+
+line_lonxs_latys = [so_funcs.destination_point(START_LONX, START_LATY, BEARING_DEG, (k + 1) * SPAN_M) for k in range(NUM_TOWERS)]
+tower_pixels = [projection.lonlat_to_global_pixel(lonx, laty, location_chipper.ZOOM) for lonx, laty in line_lonxs_latys]
+
+num_downloads = [0]
+
+def render_tile(url):
+    z, y, x = (int(part) for part in url.split('/')[-3:])
+    num_downloads[0] += 1
+    tile = numpy.full((location_chipper.TILE_SIZE, location_chipper.TILE_SIZE, 3), (50, 60, 70), dtype=numpy.uint8)
+    for px, py in tower_pixels:
+        left, top = int(px) - x * location_chipper.TILE_SIZE - TOWER_PX // 2, int(py) - y * location_chipper.TILE_SIZE - TOWER_PX // 2
+        tile[max(0, top):max(0, top + TOWER_PX), max(0, left):max(0, left + TOWER_PX)] = 255
+    content = io.BytesIO()
+    Image.fromarray(tile).save(content, 'PNG')
+    return content.getvalue()
+
+class SquareModel:
+    """
+    Stand-in for the tower model which reports every white square as a tower, and counts the pixels it was given.
+    """
+    names = {0: 'tower'}
+
+    def __init__(self):
+        self.num_pixels = 0
+
+    def detect_arrays(self, images):
+        detections = []
+        for image in images:
+            image = numpy.asarray(image)
+            self.num_pixels += image.shape[0] * image.shape[1]
+            ys, xs = numpy.nonzero(image[:, :, 0] > 200)
+            centers = []
+            for x, y in zip(xs, ys):
+                for center in centers:
+                    if abs(center[0] - x) <= 2 * TOWER_PX and abs(center[1] - y) <= 2 * TOWER_PX:
+                        center[2].append((x, y))
+                        break
+                else:
+                    centers.append((x, y, [(x, y)]))
+            xyxy = [
+                (min(x for x, y in points), min(y for x, y in points), max(x for x, y in points) + 1, max(y for x, y in points) + 1)
+                for cx, cy, points in centers
+            ]
+            detections.append((
+                numpy.asarray(xyxy, dtype=numpy.float32).reshape((-1, 4)),
+                numpy.full((len(xyxy),), 0.9, dtype=numpy.float32),
+                numpy.zeros((len(xyxy),), dtype=numpy.int32),
+            ))
+        return detections
+
+location_chipper.http_get = render_tile
+font = so_funcs.get_default_ttf_font(18)
+
+results = dict()
+for predictive in (False, True):
+    tile_store.tiles = tile_store.TileStore(tempfile.mkdtemp())
+    location_chipper.decoded_lru.clear()
+    num_downloads[0] = 0
+    model = SquareModel()
+    config = {'follow_predictive': predictive, 'follow_max_positions': 200, 'follow_max_depth': 200, 'inference_cache': False}
+    towers = tower_follower.TowerRegistry()
+    tower_follower.follow_towers(
+        config, 0, 0, tempfile.mkdtemp(), START_LONX, START_LATY, tower_follower.VisitedIndex(), model, font, 0, 0, 0, towers=towers
+    )
+    found = sum(
+        1 for lonx, laty in line_lonxs_latys
+        if any(so_funcs.haversine_m(lonx, laty, tower['lonx'], tower['laty']) < 5.0 for tower in towers.towers)
+    )
+    results[predictive] = (found, model.num_pixels, num_downloads[0])
+    print(f'follow_predictive = {predictive}: found {found} of {NUM_TOWERS} towers scanning {model.num_pixels / 1e6:.0f} Mpx from {num_downloads[0]} tiles')
+
+full_found, full_pixels, full_downloads = results[False]
+predicted_found, predicted_pixels, predicted_downloads = results[True]
+assert full_found == NUM_TOWERS
+assert predicted_found == NUM_TOWERS
+assert predicted_pixels * 8 < full_pixels
+assert predicted_downloads * 2 < full_downloads
+print('tower_follower prediction checks passed')
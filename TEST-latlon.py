@@ -118,6 +118,30 @@ for asserts_on in [False, True]:
                 assert abs(abs(approx_moved_laty_meters) - abs(moved_y_meters)) < 4.0
 
 
+# projection.py replaces add_pixels_to_coordinates with exact Web Mercator math relative to the chip's tile origin
+import projection
+
+print(f'Web Mercator puts {projection.meters_per_pixel(31.5964, ZOOM):.6f} meters in a pixel at the calibration site (zoom {ZOOM})')
+for laty in [-80.0, -60.0, -45.0, -15.0, 0.0, 15.0, 45.0, 60.0, 80.0]:
+    for lonx in [-179.9, -90.0, -45.0, 0.0, 45.0, 90.0, 179.9]:
+        px, py = projection.lonlat_to_global_pixel(lonx, laty, ZOOM)
+        chip_geo = projection.ChipGeo.centered_on_tile(int(px) // TILE_SIZE, int(py) // TILE_SIZE, ZOOM)
+        chip_x, chip_y = chip_geo.lonlat_to_pixels(lonx, laty)
+        # The position is within the center tile of its chip, not necessarily at the center pixel
+        assert (image_w // 2) - (TILE_SIZE // 2) <= chip_x <= (image_w // 2) + (TILE_SIZE // 2)
+        assert (image_h // 2) - (TILE_SIZE // 2) <= chip_y <= (image_h // 2) + (TILE_SIZE // 2)
+        # Round trips to well under a millimeter
+        back_lonx, back_laty = chip_geo.pixels_to_lonlat(chip_x, chip_y)
+        assert abs(back_lonx - lonx) < 1e-9 and abs(back_laty - laty) < 1e-9
+        # Moving one tile south-east moves TILE_SIZE pixels of ground in each direction
+        (moved_lonx, moved_laty), = chip_geo.boxes_to_lonlat([[chip_x + TILE_SIZE, chip_y + TILE_SIZE] * 2])
+        moved_x_meters = (moved_lonx - lonx) * (projection.EARTH_CIRCUMFERENCE_M / 360.0) * math.cos(math.radians(laty))
+        moved_y_meters = (laty - moved_laty) * (projection.EARTH_CIRCUMFERENCE_M / 360.0)
+        tile_meters = projection.meters_per_pixel(laty, ZOOM) * TILE_SIZE
+        assert abs(moved_x_meters - tile_meters) < 0.01
+        assert abs(moved_y_meters - tile_meters) < 0.01 * tile_meters
+print('projection.py checks passed')
+
 
 print('Done')
 
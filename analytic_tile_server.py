@@ -3,103 +3,169 @@ import os
 import sys
 import subprocess
 import threading
+import collections
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
 from PIL import Image
-import requests
+import staticmap
 import io
 import re
 
+import location_chipper
+import tile_store
+
 # USE_OVERLAY = True
 USE_OVERLAY = False
 
 # Esri tile sources
 IMAGERY_URL = "https://services.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
 LABELS_URL  = "https://services.arcgisonline.com/ArcGIS/rest/services/Reference/World_Reference_Overlay/MapServer/tile/{z}/{y}/{x}"
+IMAGERY_LAYER = location_chipper.TILE_LAYER
+LABELS_LAYER = 'world-reference-overlay'
 
-IMAGERY_EXPIRE_SECONDS = 7 * 24 * 60 * 60 # 1 week
+# Composited (imagery + labels) tiles are re-encoded as PNG, so the most recent ones are kept around
+# keyed by (z, x, y, overlay) to pay that cost only once per tile.
+COMPOSITED_CACHE_MAX_TILES = 2048
 
-at_d_cache = None
 server_inst = None
 
+composited_tiles = collections.OrderedDict()
+composited_tiles_lock = threading.Lock()
+
+def upstream_bytes(layer, url_template, z, y, x):
+  return location_chipper.fetch_tile_bytes(layer, url_template, z, x, y)
+
+def open_imagery_tile(z, y, x):
+  """
+  Returns the imagery tile as an open file in tile_store, downloading it first if needed.
+  Returns None if the tile was evicted again before it could be opened.
+  """
+  fd = tile_store.tiles.open(IMAGERY_LAYER, z, x, y)
+  if fd is None:
+    upstream_bytes(IMAGERY_LAYER, IMAGERY_URL, z, y, x)
+    fd = tile_store.tiles.open(IMAGERY_LAYER, z, x, y, track=False)
+  return fd
+
+def tile_bytes(z, y, x, use_overlay=None):
+  """
+  Returns (content type, encoded bytes) for one tile. Without an overlay the cached upstream bytes are returned untouched.
+  """
+  if use_overlay is None:
+    use_overlay = USE_OVERLAY
+
+  img_bytes = upstream_bytes(IMAGERY_LAYER, IMAGERY_URL, z, y, x)
+  if not use_overlay:
+    return tile_store.content_type(img_bytes), img_bytes
+
+  key = (z, x, y, use_overlay)
+  with composited_tiles_lock:
+    if key in composited_tiles:
+      composited_tiles.move_to_end(key)
+      return 'image/png', composited_tiles[key]
+
+  lbl_bytes = upstream_bytes(LABELS_LAYER, LABELS_URL, z, y, x)
+  base_img = Image.open(io.BytesIO(img_bytes)).convert("RGBA")
+  overlay_img = Image.open(io.BytesIO(lbl_bytes)).convert("RGBA")
+  composed = Image.alpha_composite(base_img, overlay_img)
+
+  png_bytes = io.BytesIO()
+  composed.save(png_bytes, format='PNG')
+  png_bytes = png_bytes.getvalue()
+
+  with composited_tiles_lock:
+    composited_tiles[key] = png_bytes
+    while len(composited_tiles) > COMPOSITED_CACHE_MAX_TILES:
+      composited_tiles.popitem(last=False)
+  return 'image/png', png_bytes
+
 class TileHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        global at_d_cache
+    # Keep-alive lets clients such as staticmap fetch many tiles over one connection
+    protocol_version = 'HTTP/1.1'
 
+    def send_body(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
         parsed = urlparse(self.path)
         match = re.match(r'^/tile/(\d+)/(\d+)/(\d+)\.png$', parsed.path)
         if not match:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b'Invalid tile path. Use /tile/{z}/{y}/{x}.png')
+            self.send_body(404, "text/plain", b'Invalid tile path. Use /tile/{z}/{y}/{x}.png')
             return
 
         z, y, x = map(int, match.groups())
 
         try:
-            # Fetch imagery tile
-            img_url = IMAGERY_URL.format(z=z, y=y, x=x)
-            if USE_OVERLAY:
-              lbl_url = LABELS_URL.format(z=z, y=y, x=x)
-
-            img_bytes = at_d_cache.get(img_url, None)
-            if img_bytes is None:
-              img_bytes = requests.get(img_url).content
-              at_d_cache.set(img_url, img_bytes, expire=IMAGERY_EXPIRE_SECONDS)
-
-            if USE_OVERLAY:
-              lbl_bytes = at_d_cache.get(lbl_url, None)
-              if lbl_bytes is None:
-                lbl_bytes = requests.get(lbl_url).content
-                at_d_cache.set(lbl_url, lbl_bytes, expire=IMAGERY_EXPIRE_SECONDS)
-
-            base_img = Image.open(io.BytesIO(img_bytes)).convert("RGBA")
-            if USE_OVERLAY:
-              overlay_img = Image.open(io.BytesIO(lbl_bytes)).convert("RGBA")
-
-            # Composite tiles
-            if USE_OVERLAY:
-              composed = Image.alpha_composite(base_img, overlay_img)
-            else:
-              composed = base_img
-
-            # Respond with PNG
-            img_bytes = io.BytesIO()
-            composed.save(img_bytes, format='PNG')
-            img_bytes.seek(0)
+            fd = None if USE_OVERLAY else open_imagery_tile(z, y, x)
+            if fd is not None:
+                self.send_file(fd)
+                return
+            # Overlays are composited in memory; a tile evicted between download and open is fetched again as bytes
+            content_type, body = tile_bytes(z, y, x)
+        except Exception as e:
+            self.send_body(500, "text/plain", f"Error fetching/composing tile: {e}".encode("utf-8"))
+            return
 
-            self.send_response(200)
-            self.send_header("Content-type", "image/png")
-            self.send_header("Content-length", str(len(img_bytes.getvalue())))
-            self.end_headers()
-            self.wfile.write(img_bytes.read())
+        self.send_body(200, content_type, body)
 
-        except Exception as e:
-            self.send_response(500)
+    def send_file(self, fd):
+        # Tiles are passed through untouched, so the kernel can copy them from the tile_store file straight to the socket
+        with fd:
+            size = os.fstat(fd.fileno()).st_size
+            content_type = tile_store.content_type(fd.read(8))
+            self.send_response(200)
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-length", str(size))
             self.end_headers()
-            self.wfile.write(f"Error fetching/composing tile: {e}".encode("utf-8"))
+            self.wfile.flush()
+            self.connection.sendfile(fd, 0)
 
      # Suppress all logging output
     def log_message(self, format, *args):
         pass
 
 
+class InProcessStaticMap(staticmap.StaticMap):
+  """
+  staticmap.StaticMap which reads tiles straight out of tile_store via tile_bytes() instead of over HTTP,
+  so no server thread, port or PNG re-encode is needed to render a map.
+  """
+  URL_TEMPLATE = 'inproc:///tile/{z}/{y}/{x}.png'
+
+  def __init__(self, width, height, **kwargs):
+    super().__init__(width, height, url_template=InProcessStaticMap.URL_TEMPLATE, **kwargs)
+
+  def get(self, url, **kwargs):
+    match = re.match(r'^inproc:///tile/(\d+)/(\d+)/(\d+)\.png$', url)
+    z, y, x = map(int, match.groups())
+    try:
+      content_type, body = tile_bytes(z, y, x)
+    except Exception as e:
+      print(f'Error fetching/composing tile {url}: {e}')
+      return 500, None
+    return 200, body
+
+
 def shutdown():
   global server_inst
   if server_inst is not None:
     server_inst.shutdown()
 
-def run(d_cache, port):
-  global at_d_cache, server_inst
-  at_d_cache = d_cache
-  httpd = HTTPServer(('127.0.0.1', port), TileHandler)
+def run(port, threaded=True):
+  global server_inst
+  if threaded:
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), TileHandler)
+  else:
+    httpd = HTTPServer(('127.0.0.1', port), TileHandler)
   print(f"Serving tile proxy at http://localhost:{port}/tile/z/y/x.png")
   server_inst = httpd
   httpd.serve_forever()
 
-def spawn_run_thread(d_cache, port):
-  t = threading.Thread(target=run, args=(d_cache, port))
+def spawn_run_thread(port, threaded=True):
+  t = threading.Thread(target=run, args=(port, threaded))
   t.start()
   return t
-
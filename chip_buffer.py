@@ -0,0 +1,150 @@
+
+# Designed to be imported by location_chipper.py, tower_follower.py, inference.py and inference_daemon.py
+
+# A 2816x2816 chip is ~24mb. Chips are stitched straight into shared memory and every later stage works on a numpy
+# view of the same block, so handing a chip to another thread, process or the inference daemon only passes its name.
+# Pickling a SharedChip (eg to a multiprocessing worker) sends the name and shape, not the pixels.
+#
+# On Linux shared memory lives in /dev/shm, which docker limits to 64mb by default. A block is only backed by memory
+# once it is written to, and a write that does not fit kills the process with SIGBUS instead of raising an error, so
+# every block's pages are reserved when it is created; a chip whose block does not fit is made a plain numpy array
+# in this process instead.
+
+import os
+import sys
+import errno
+import queue
+import multiprocessing.shared_memory
+import multiprocessing.resource_tracker
+
+import numpy
+
+SHM_PATH = '/dev/shm'
+warned_no_shm = False
+
+def create_shared_memory(num_bytes):
+    """
+    Returns a new num_bytes SharedMemory block whose pages are already reserved in /dev/shm, or None if they do not fit.
+    Where blocks are not files in /dev/shm (or posix_fallocate is missing) the block is returned unreserved.
+    """
+    try:
+        shm = multiprocessing.shared_memory.SharedMemory(create=True, size=num_bytes)
+    except OSError:
+        return None
+    path = os.path.join(SHM_PATH, shm.name.lstrip('/'))
+    if not hasattr(os, 'posix_fallocate') or not os.path.exists(path):
+        return shm
+    try:
+        fd = os.open(path, os.O_RDWR)
+        try:
+            os.posix_fallocate(fd, 0, num_bytes)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        shm.close()
+        shm.unlink()
+        if e.errno in (errno.ENOSPC, errno.ENOMEM):
+            return None
+        raise
+    return shm
+
+def attach_shared_memory(name, own_tracker=True):
+    """
+    Opens another process's shared memory block without taking ownership of it; its creator unlinks it.
+    own_tracker is False in processes started through multiprocessing by the creator, which share its resource tracker.
+    """
+    if sys.version_info >= (3, 13):
+        return multiprocessing.shared_memory.SharedMemory(name=name, track=False)
+    shm = multiprocessing.shared_memory.SharedMemory(name=name)
+    if own_tracker:
+        # Older pythons register every attached block with this process's tracker, which would unlink it when we exit
+        multiprocessing.resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+class SharedChip:
+    """
+    A height x width x 3 uint8 image in a shared memory block. pixels is a numpy view of the block; numpy.asarray(chip) returns it too.
+    The process which created the chip unlinks it, every other process only closes it.
+    When /dev/shm has no room for the block the chip holds a plain numpy array instead (shm and name are None) and is
+    copied when pickled.
+    """
+    def __init__(self, shape, name=None, ring=None, pixels=None):
+        global warned_no_shm
+        self.shape = tuple(shape)
+        self.owner = name is None
+        self.ring = ring
+        self.shm = None
+        num_bytes = max(1, int(numpy.prod(self.shape)))
+        if not self.owner:
+            # Chips are attached by unpickling, ie in multiprocessing workers of the creating process
+            self.shm = attach_shared_memory(name, own_tracker=False)
+        elif pixels is None:
+            self.shm = create_shared_memory(num_bytes)
+        if self.shm is None:
+            if pixels is None and not warned_no_shm:
+                warned_no_shm = True
+                print(f'Not enough free space in {SHM_PATH} for {num_bytes // (1024 * 1024)}mb chips, keeping them in process memory (give docker a larger --shm-size)')
+            self.name = None
+            self.pixels = numpy.empty(self.shape, dtype=numpy.uint8) if pixels is None else pixels
+        else:
+            self.name = self.shm.name
+            self.pixels = numpy.ndarray(self.shape, dtype=numpy.uint8, buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, name, shape):
+        return cls(shape, name=name)
+
+    @classmethod
+    def from_pixels(cls, pixels):
+        return cls(pixels.shape, pixels=pixels)
+
+    def __reduce__(self):
+        if self.shm is None:
+            return (SharedChip.from_pixels, (self.pixels,))
+        return (SharedChip.attach, (self.name, self.shape))
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is not None and numpy.dtype(dtype) != self.pixels.dtype:
+            return self.pixels.astype(dtype)
+        return self.pixels
+
+    def release(self):
+        """
+        Hands the chip back to the ChipRing it came from, or frees it if it did not come from one.
+        """
+        if self.ring is not None:
+            self.ring.release(self)
+        else:
+            self.free()
+
+    def free(self):
+        self.pixels = None
+        if self.shm is None:
+            return
+        try:
+            self.shm.close()
+        except BufferError:
+            pass # Views of pixels are still alive elsewhere; the mapping goes away with the last of them
+        if self.owner:
+            self.shm.unlink()
+
+class ChipRing:
+    """
+    A fixed set of equally sized SharedChips which are re-used instead of creating a block per chip.
+    acquire() blocks while every chip is in use, which also bounds how many chips a pipeline holds at once.
+    """
+    def __init__(self, count, shape):
+        self.chips = [SharedChip(shape, ring=self) for _ in range(count)]
+        self.free_chips = queue.Queue()
+        for chip in self.chips:
+            self.free_chips.put(chip)
+
+    def acquire(self):
+        return self.free_chips.get()
+
+    def release(self, chip):
+        self.free_chips.put(chip)
+
+    def free(self):
+        for chip in self.chips:
+            chip.free()
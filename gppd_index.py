@@ -0,0 +1,202 @@
+
+# Designed to be imported by world-current.py
+
+# The Global Power Plant Database is a ~35k row .csv; parsing all of it into dicts on every run takes
+# seconds, so the first run ingests it into memory-mappable numpy columns sorted by a 1-degree grid
+# and every later run only reads back the .csv rows a region query actually selects.
+
+import os
+import io
+import csv
+import json
+import shutil
+import hashlib
+
+import numpy
+import platformdirs
+
+GPPD_CACHE_DIR = os.path.join(platformdirs.user_cache_dir('world-current'), 'gppd')
+INGEST_VERSION = 1
+
+GRID_CELL_DEGREES = 1.0
+GRID_W = int(360 / GRID_CELL_DEGREES)
+GRID_H = int(180 / GRID_CELL_DEGREES)
+
+COLUMN_NAMES = ['lonx', 'laty', 'fuel_codes', 'row_numbers', 'row_offsets', 'row_lengths', 'cell_starts']
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def grid_cell_xy(lonx, laty):
+    cell_x = numpy.clip(numpy.floor((numpy.asarray(lonx) + 180.0) / GRID_CELL_DEGREES).astype(numpy.int64), 0, GRID_W - 1)
+    cell_y = numpy.clip(numpy.floor((numpy.asarray(laty) + 90.0) / GRID_CELL_DEGREES).astype(numpy.int64), 0, GRID_H - 1)
+    return cell_x, cell_y
+
+def iter_csv_records(csv_path):
+    """
+    Yields (byte offset, byte length, text) for every record after the header, joining lines while a quoted field is still open.
+    """
+    with open(csv_path, 'rb') as fd:
+        fd.readline() # header
+        offset = fd.tell()
+        record = b''
+        for line in iter(fd.readline, b''):
+            record += line
+            if record.count(b'"') % 2 == 1:
+                continue
+            yield offset, len(record), record.decode('utf-8')
+            offset += len(record)
+            record = b''
+
+def read_csv_header(csv_path):
+    with open(csv_path, 'r', newline='', encoding='utf-8-sig') as fd:
+        return next(csv.reader(fd))
+
+def ingest(csv_path, folder):
+    fieldnames = read_csv_header(csv_path)
+    lon_i = fieldnames.index('longitude')
+    lat_i = fieldnames.index('latitude')
+    fuel_i = fieldnames.index('primary_fuel') if 'primary_fuel' in fieldnames else None
+
+    lonx, laty, fuel_codes, row_numbers, row_offsets, row_lengths = [], [], [], [], [], []
+    fuel_names = []
+    for row_number, (offset, length, text) in enumerate(iter_csv_records(csv_path)):
+        row = next(csv.reader(io.StringIO(text, newline='')), [])
+        try:
+            row_lonx = float(row[lon_i])
+            row_laty = float(row[lat_i])
+        except (IndexError, ValueError):
+            continue # rows without a position can never fall within a region
+        fuel = row[fuel_i] if fuel_i is not None and fuel_i < len(row) else ''
+        if not fuel in fuel_names:
+            fuel_names.append(fuel)
+        lonx.append(row_lonx)
+        laty.append(row_laty)
+        fuel_codes.append(fuel_names.index(fuel))
+        row_numbers.append(row_number)
+        row_offsets.append(offset)
+        row_lengths.append(length)
+
+    columns = {
+        'lonx': numpy.array(lonx, dtype=numpy.float64),
+        'laty': numpy.array(laty, dtype=numpy.float64),
+        'fuel_codes': numpy.array(fuel_codes, dtype=numpy.uint16),
+        'row_numbers': numpy.array(row_numbers, dtype=numpy.int64),
+        'row_offsets': numpy.array(row_offsets, dtype=numpy.int64),
+        'row_lengths': numpy.array(row_lengths, dtype=numpy.int64),
+    }
+    # Sort every column by grid cell so all rows of one cell (and of a run of cells along one grid row) are contiguous
+    cell_x, cell_y = grid_cell_xy(columns['lonx'], columns['laty'])
+    cell_ids = (cell_y * GRID_W) + cell_x
+    order = numpy.argsort(cell_ids, kind='stable')
+    for name in list(columns.keys()):
+        columns[name] = columns[name][order]
+    columns['cell_starts'] = numpy.searchsorted(cell_ids[order], numpy.arange(GRID_W * GRID_H + 1)).astype(numpy.int64)
+
+    stat = os.stat(csv_path)
+    meta = {
+        'ingest_version': INGEST_VERSION,
+        'csv_path': os.path.abspath(csv_path),
+        'csv_size': stat.st_size,
+        'csv_mtime_ns': stat.st_mtime_ns,
+        'csv_sha256': file_sha256(csv_path),
+        'fieldnames': fieldnames,
+        'fuel_names': fuel_names,
+    }
+
+    tmp_folder = f'{folder}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder, exist_ok=True)
+    for name, values in columns.items():
+        numpy.save(os.path.join(tmp_folder, f'{name}.npy'), values)
+    with open(os.path.join(tmp_folder, 'meta.json'), 'w') as fd:
+        json.dump(meta, fd)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp_folder, folder)
+
+def ingest_is_current(csv_path, folder):
+    meta_path = os.path.join(folder, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as fd:
+        meta = json.load(fd)
+    if meta.get('ingest_version', None) != INGEST_VERSION:
+        return False
+    stat = os.stat(csv_path)
+    if meta['csv_size'] == stat.st_size and meta['csv_mtime_ns'] == stat.st_mtime_ns:
+        return True
+    # Touched or copied but possibly identical; only pay for a re-ingest when the content changed
+    if meta['csv_size'] == stat.st_size and meta['csv_sha256'] == file_sha256(csv_path):
+        meta['csv_mtime_ns'] = stat.st_mtime_ns
+        with open(meta_path, 'w') as fd:
+            json.dump(meta, fd)
+        return True
+    return False
+
+class GPPDIndex:
+    def __init__(self, csv_path, folder):
+        self.csv_path = csv_path
+        with open(os.path.join(folder, 'meta.json'), 'r') as fd:
+            meta = json.load(fd)
+        self.fieldnames = meta['fieldnames']
+        self.fuel_names = meta['fuel_names']
+        for name in COLUMN_NAMES:
+            setattr(self, name, numpy.load(os.path.join(folder, f'{name}.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.lonx)
+
+    def query_bbox(self, minx, miny, maxx, maxy):
+        """
+        Returns the indices of every plant with minx <= lonx <= maxx and miny <= laty <= maxy, in .csv order.
+        Only rows in grid cells overlapping the box are tested.
+        """
+        (cell_x0, cell_x1), (cell_y0, cell_y1) = grid_cell_xy([minx, maxx], [miny, maxy])
+        candidates = []
+        for cell_y in range(int(cell_y0), int(cell_y1) + 1):
+            start = self.cell_starts[(cell_y * GRID_W) + cell_x0]
+            end = self.cell_starts[(cell_y * GRID_W) + cell_x1 + 1]
+            if end > start:
+                candidates.append(numpy.arange(start, end))
+        if len(candidates) < 1:
+            return numpy.zeros((0,), dtype=numpy.int64)
+        candidates = numpy.concatenate(candidates)
+        lonx = self.lonx[candidates]
+        laty = self.laty[candidates]
+        inside = (minx <= lonx) & (lonx <= maxx) & (miny <= laty) & (laty <= maxy)
+        selected = candidates[inside]
+        return selected[numpy.argsort(self.row_numbers[selected], kind='stable')]
+
+    def fuels(self, indices):
+        return [self.fuel_names[code] for code in self.fuel_codes[indices]]
+
+    def rows(self, indices):
+        """
+        Reads the full .csv rows for indices back as dicts, like so_funcs.cvs2dicts would have returned them.
+        """
+        rows = []
+        with open(self.csv_path, 'rb') as fd:
+            for idx in indices:
+                fd.seek(int(self.row_offsets[idx]))
+                text = fd.read(int(self.row_lengths[idx])).decode('utf-8')
+                values = next(csv.reader(io.StringIO(text, newline='')), [])
+                row = dict(zip(self.fieldnames, values))
+                for name in self.fieldnames[len(values):]:
+                    row[name] = None
+                rows.append(row)
+        return rows
+
+def load(csv_path):
+    """
+    Returns a GPPDIndex for csv_path, re-ingesting the .csv first if it changed since the last ingest.
+    """
+    folder = os.path.join(GPPD_CACHE_DIR, hashlib.sha256(os.path.abspath(csv_path).encode('utf-8')).hexdigest()[:16])
+    if not ingest_is_current(csv_path, folder):
+        print(f'Ingesting {csv_path} into {folder}')
+        os.makedirs(GPPD_CACHE_DIR, exist_ok=True)
+        ingest(csv_path, folder)
+    return GPPDIndex(csv_path, folder)
@@ -0,0 +1,442 @@
+
+# Designed to be imported by world-current.py, tower_follower.py and run-yolo-detections.py
+
+# Runs the tower model over chips and returns compact per-image detections: an (xyxy, conf, cls) tuple of
+# (N, 4) float32, (N,) float32 and (N,) int32 numpy arrays in the chip's pixel coordinates.
+#
+# Chips are 2816x2816 but the model is trained at imgsz=1694; handing a whole chip to ultralytics shrinks it to the model's
+# input size first, and small lattice towers shrink to a few pixels. Sliced inference instead cuts every chip into
+# overlapping windows of the model's input size, runs all windows of all chips through the model as one batch at full
+# resolution, and merges boxes found twice in the overlaps with NMS.
+#
+# Detections are cached in diskcache keyed by a hash of the chip's pixels, the model file and every parameter
+# that changes the result, so re-running a region or re-following a line only runs the model on new imagery.
+# Set IGNORE_CACHES=detections to skip cache lookups.
+#
+# With prefilter set, chips showing fewer short straight segments per megapixel than that (see
+# tower_detections.line_structure_score) are not run through the model at all and get no detections; sparse rural
+# regions are mostly such chips.
+#
+# With inference_daemon set, models are not loaded in this process at all: load_model returns a RemoteModel which
+# hands chips to inference_daemon.py through shared memory and a Unix socket, starting the daemon if needed.
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import hashlib
+import threading
+import subprocess
+
+import numpy
+import diskcache
+import platformdirs
+
+import chip_buffer
+import tower_detections
+
+DEFAULT_SLICE_PX = 1694 # run-yolo-training.py trains with imgsz=1694
+DEFAULT_SLICE_OVERLAP = 0.2
+DEFAULT_NMS_IOU = 0.5
+# A box mostly inside a more confident one is the same tower cut off at a window edge
+DEFAULT_NMS_IOS = 0.8
+
+DETECTIONS_CACHE_DIR = os.path.join(platformdirs.user_cache_dir('world-current'), 'detections')
+DAEMON_SOCKET_PATH = os.path.join(platformdirs.user_cache_dir('world-current'), 'inference.sock')
+DAEMON_START_TIMEOUT_S = 120
+DETECTIONS_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+detections_cache = None
+model_fingerprints = dict() # (path, size, mtime) -> sha256 of the model file
+model_fingerprints_lock = threading.Lock()
+
+def empty_detections():
+    return numpy.zeros((0, 4), dtype=numpy.float32), numpy.zeros((0,), dtype=numpy.float32), numpy.zeros((0,), dtype=numpy.int32)
+
+def result_detections(result):
+    """
+    Converts one ultralytics result to (xyxy, conf, cls) arrays.
+    """
+    boxes = result.boxes
+    if boxes is None or len(boxes) < 1:
+        return empty_detections()
+    return (
+        numpy.asarray(boxes.xyxy.cpu().numpy() if hasattr(boxes.xyxy, 'cpu') else boxes.xyxy, dtype=numpy.float32).reshape((-1, 4)),
+        numpy.asarray(boxes.conf.cpu().numpy() if hasattr(boxes.conf, 'cpu') else boxes.conf, dtype=numpy.float32).reshape((-1,)),
+        numpy.asarray(boxes.cls.cpu().numpy() if hasattr(boxes.cls, 'cpu') else boxes.cls, dtype=numpy.int32).reshape((-1,)),
+    )
+
+def model_imgsz(yolo_model, default=DEFAULT_SLICE_PX):
+    """
+    The input size yolo_model was trained at, which ultralytics keeps in the checkpoint's args.
+    """
+    imgsz = getattr(yolo_model, 'imgsz', None) # onnx_backend.ExportedModel
+    if imgsz is None:
+        imgsz = getattr(yolo_model, 'overrides', dict()).get('imgsz', None)
+    if imgsz is None:
+        imgsz = getattr(getattr(yolo_model, 'model', None), 'args', dict()).get('imgsz', None)
+    if isinstance(imgsz, (list, tuple)):
+        imgsz = max(imgsz)
+    return int(imgsz) if imgsz else default
+
+def slice_starts(length, slice_px, overlap):
+    """
+    Returns the start offsets of windows slice_px long covering 0..length, each overlapping the next by at least overlap * slice_px.
+    """
+    if length <= slice_px:
+        return [0]
+    stride = max(1, int(slice_px * (1.0 - overlap)))
+    num_slices = 1 + -(-(length - slice_px) // stride) # ceil
+    # Spread the windows evenly so the last one ends exactly at length
+    return [round(k * (length - slice_px) / (num_slices - 1)) for k in range(num_slices)]
+
+def slice_windows(width, height, slice_px, overlap):
+    """
+    Returns (x0, y0, x1, y1) of every window for a width x height image.
+    """
+    return [
+        (x0, y0, min(width, x0 + slice_px), min(height, y0 + slice_px))
+        for y0 in slice_starts(height, slice_px, overlap) for x0 in slice_starts(width, slice_px, overlap)
+    ]
+
+def nms(xyxy, conf, cls, iou=DEFAULT_NMS_IOU, ios=DEFAULT_NMS_IOS):
+    """
+    Greedy per-class non-max suppression. A box is dropped when a more confident box of the same class overlaps it by more than
+    iou (intersection over union) or covers more than ios of the smaller box (intersection over smaller, not tested when ios is None).
+    Returns the indices kept, most confident first.
+    """
+    if len(conf) < 1:
+        return numpy.zeros((0,), dtype=numpy.int64)
+    order = numpy.argsort(-conf, kind='stable')
+    areas = numpy.maximum(0.0, xyxy[:, 2] - xyxy[:, 0]) * numpy.maximum(0.0, xyxy[:, 3] - xyxy[:, 1])
+    keep = []
+    while len(order) > 0:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        inter_w = numpy.maximum(0.0, numpy.minimum(xyxy[best, 2], xyxy[rest, 2]) - numpy.maximum(xyxy[best, 0], xyxy[rest, 0]))
+        inter_h = numpy.maximum(0.0, numpy.minimum(xyxy[best, 3], xyxy[rest, 3]) - numpy.maximum(xyxy[best, 1], xyxy[rest, 1]))
+        inter = inter_w * inter_h
+        union = areas[best] + areas[rest] - inter
+        overlapping = inter > iou * numpy.maximum(union, 1e-9)
+        if ios is not None:
+            overlapping |= inter > ios * numpy.maximum(numpy.minimum(areas[best], areas[rest]), 1e-9)
+        suppressed = (cls[rest] == cls[best]) & overlapping
+        order = rest[~suppressed]
+    return numpy.array(keep, dtype=numpy.int64)
+
+def run_model(yolo_model, images, **kwargs):
+    """
+    Runs images (a list of HxWx3 uint8 arrays) through yolo_model as one batch and returns a list of (xyxy, conf, cls).
+    """
+    if len(images) < 1:
+        return []
+    if hasattr(yolo_model, 'detect_arrays'):
+        return yolo_model.detect_arrays(images, **kwargs)
+    return [result_detections(result) for result in yolo_model(images, batch=len(images), verbose=False, **kwargs)]
+
+def sliced_detect(yolo_model, images, slice_px=None, overlap=DEFAULT_SLICE_OVERLAP, iou=DEFAULT_NMS_IOU, ios=DEFAULT_NMS_IOS):
+    """
+    Sliced inference over images, returning a list of (xyxy, conf, cls) in each image's own pixel coordinates.
+    """
+    if slice_px is None:
+        slice_px = model_imgsz(yolo_model)
+    windows = []
+    owners = []
+    for image_k, image in enumerate(images):
+        for x0, y0, x1, y1 in slice_windows(image.shape[1], image.shape[0], slice_px, overlap):
+            windows.append( (x0, y0, image[y0:y1, x0:x1]) )
+            owners.append(image_k)
+
+    window_detections = run_model(yolo_model, [pixels for x0, y0, pixels in windows], imgsz=slice_px)
+
+    per_image = [ [] for image in images ]
+    for image_k, (x0, y0, pixels), (xyxy, conf, cls) in zip(owners, windows, window_detections):
+        per_image[image_k].append( (xyxy + numpy.array([x0, y0, x0, y0], dtype=numpy.float32), conf, cls) )
+
+    merged = []
+    for parts in per_image:
+        if len(parts) < 1:
+            merged.append(empty_detections())
+            continue
+        xyxy = numpy.concatenate([part[0] for part in parts])
+        conf = numpy.concatenate([part[1] for part in parts])
+        cls = numpy.concatenate([part[2] for part in parts])
+        keep = nms(xyxy, conf, cls, iou=iou, ios=ios)
+        merged.append( (xyxy[keep], conf[keep], cls[keep]) )
+    return merged
+
+def get_detections_cache():
+    global detections_cache
+    if detections_cache is None:
+        detections_cache = diskcache.Cache(
+            DETECTIONS_CACHE_DIR, size_limit=DETECTIONS_CACHE_MAX_BYTES, eviction_policy='least-recently-used'
+        )
+    return detections_cache
+
+def model_file(yolo_model):
+    """
+    The file yolo_model was loaded from; ultralytics keeps it as ckpt_path, onnx_backend.ExportedModel as model_file.
+    """
+    for name in ('model_file', 'ckpt_path'):
+        path = getattr(yolo_model, name, None)
+        if isinstance(path, (str, os.PathLike)) and os.path.exists(path):
+            return os.fspath(path)
+    return None
+
+def model_fingerprint(yolo_model):
+    """
+    sha256 of the file yolo_model was loaded from, hashed once per file version. None if it cannot be determined.
+    """
+    model_hash = getattr(yolo_model, 'model_hash', None) # RemoteModel
+    if model_hash is not None:
+        return model_hash
+    path = model_file(yolo_model)
+    if path is None:
+        return None
+    return file_fingerprint(path)
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with model_fingerprints_lock:
+        if not key in model_fingerprints:
+            h = hashlib.sha256()
+            with open(path, 'rb') as fd:
+                for block in iter(lambda: fd.read(1024 * 1024), b''):
+                    h.update(block)
+            model_fingerprints[key] = h.hexdigest()
+        return model_fingerprints[key]
+
+def detections_key(image, model_hash, params):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(model_hash.encode('utf-8'))
+    h.update(params.encode('utf-8'))
+    h.update(repr(image.shape).encode('utf-8'))
+    h.update(numpy.ascontiguousarray(image).data)
+    return f'detections-{h.hexdigest()}'
+
+def detect(yolo_model, images, sliced=False, use_cache=True, prefilter=0, **kwargs):
+    """
+    Runs images (a list of HxWx3 uint8 arrays or chip_buffer.SharedChips) through yolo_model, sliced or whole,
+    returning a list of (xyxy, conf, cls). With use_cache only the images whose detections are not cached yet go through the model,
+    and with prefilter only the images with at least that many line-like segments per megapixel.
+    """
+    if prefilter > 0:
+        detections = [empty_detections() for _ in images]
+        # Per megapixel, so small prediction windows are held to the same density as whole chips
+        keep = [
+            k for k, image in enumerate(images)
+            if tower_detections.line_structure_score(image) >= prefilter * numpy.prod(numpy.shape(image)[:2]) / 1e6
+        ]
+        if len(keep) < len(images):
+            print(f'Skipping the model for {len(images) - len(keep)} of {len(images)} chips without line-like structure')
+        if len(keep) > 0:
+            for k, found in zip(keep, detect(yolo_model, [images[k] for k in keep], sliced=sliced, use_cache=use_cache, **kwargs)):
+                detections[k] = found
+        return detections
+    if isinstance(yolo_model, RemoteModel):
+        # The daemon batches and caches on its side
+        return yolo_model.detect(images, sliced=sliced, use_cache=use_cache, **kwargs)
+    images = [numpy.asarray(image) for image in images]
+    def run(images):
+        if sliced:
+            return sliced_detect(yolo_model, images, **kwargs)
+        return run_model(yolo_model, images)
+
+    model_hash = model_fingerprint(yolo_model) if use_cache else None
+    if model_hash is None or len(images) < 1:
+        return run(images)
+
+    params = json.dumps({
+        'sliced': sliced, 'imgsz': model_imgsz(yolo_model), 'backend': getattr(yolo_model, 'backend', 'ultralytics'), **kwargs
+    }, sort_keys=True, default=str)
+    keys = [detections_key(image, model_hash, params) for image in images]
+    cache = get_detections_cache()
+    if 'detections' in os.environ.get('IGNORE_CACHES', ''):
+        detections = [None] * len(images)
+    else:
+        detections = [cache.get(key, None) for key in keys]
+    misses = [k for k, found in enumerate(detections) if found is None]
+    if len(misses) > 0:
+        for k, found in zip(misses, run([images[k] for k in misses])):
+            detections[k] = found
+            cache.set(keys[k], found)
+    return detections
+
+def send_message(sock, message):
+    """
+    Sends message as length-prefixed JSON.
+    """
+    payload = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(payload)) + payload)
+
+def recv_exactly(sock, num_bytes):
+    chunks = []
+    while num_bytes > 0:
+        chunk = sock.recv(min(num_bytes, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError('Inference daemon connection closed')
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b''.join(chunks)
+
+def recv_message(sock):
+    """
+    Returns the next length-prefixed JSON message from sock, or None if the other side closed the connection.
+    """
+    header = sock.recv(4, socket.MSG_WAITALL)
+    if len(header) < 4:
+        return None
+    return json.loads(recv_exactly(sock, struct.unpack('>I', header)[0]).decode('utf-8'))
+
+def model_options(config):
+    """
+    The load_model config keys which select how a model file is run.
+    """
+    return {
+        'inference_backend': config.get('inference_backend', 'ultralytics'),
+        'inference_threads': int(config.get('inference_threads', 0)),
+        'inference_int8': bool(config.get('inference_int8', False)),
+    }
+
+def connect_daemon(socket_path=DAEMON_SOCKET_PATH, autostart=True):
+    """
+    Connects to inference_daemon.py at socket_path, starting it first when autostart is set and nothing is listening.
+    """
+    deadline = None
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if not autostart:
+                raise
+        if deadline is None:
+            cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inference_daemon.py'), '--socket', socket_path]
+            print(f'Starting inference daemon: {" ".join(cmd)}')
+            subprocess.Popen(cmd, start_new_session=True, stdin=subprocess.DEVNULL)
+            deadline = time.monotonic() + DAEMON_START_TIMEOUT_S
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'Inference daemon did not start listening on {socket_path} within {DAEMON_START_TIMEOUT_S}s')
+        time.sleep(0.25)
+
+class RemoteModel:
+    """
+    Stands in for a model loaded by inference_daemon.py. Only the names, offsets and shapes of shared memory blocks travel
+    over the socket: chip_buffer.SharedChips are referenced where they are, other arrays are copied into one block per call.
+    Detections come back as compact arrays.
+    One connection is kept per thread.
+    """
+    def __init__(self, path_to_tower_model_file, config=dict()):
+        self.socket_path = config.get('inference_daemon_socket', DAEMON_SOCKET_PATH)
+        self.model_path = os.path.abspath(path_to_tower_model_file)
+        self.options = model_options(config)
+        self.local = threading.local()
+        reply = self.request({'op': 'load', 'model': self.model_path, 'options': self.options})
+        self.names = {int(k): v for k, v in reply['names'].items()}
+        self.imgsz = reply['imgsz']
+        self.backend = self.options['inference_backend']
+        self.model_hash = reply['model_hash']
+
+    def request(self, message):
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            sock = self.local.sock = connect_daemon(self.socket_path)
+        try:
+            send_message(sock, message)
+            reply = recv_message(sock)
+        except:
+            self.local.sock = None
+            sock.close()
+            raise
+        if reply is None:
+            self.local.sock = None
+            raise ConnectionError('Inference daemon closed the connection')
+        if 'error' in reply:
+            raise RuntimeError(f'Inference daemon failed: {reply["error"]}')
+        return reply
+
+    def detect(self, images, **detect_kwargs):
+        if len(images) < 1:
+            return []
+        def is_shared(image):
+            return isinstance(image, chip_buffer.SharedChip) and image.shm is not None
+        to_copy = [numpy.asarray(image) for image in images if not is_shared(image)]
+        shm = None
+        if len(to_copy) > 0:
+            num_bytes = max(1, sum(image.nbytes for image in to_copy))
+            shm = chip_buffer.create_shared_memory(num_bytes)
+            if shm is None:
+                raise RuntimeError(
+                    f'Not enough free space in {chip_buffer.SHM_PATH} to hand {num_bytes // (1024 * 1024)}mb of chips to the inference daemon; '
+                    'give docker a larger --shm-size or turn inference_daemon off'
+                )
+        try:
+            chips = []
+            offset = 0
+            for image in images:
+                if is_shared(image):
+                    chips.append({'shm': image.name, 'offset': 0, 'shape': list(image.shape)})
+                    continue
+                image = numpy.asarray(image)
+                numpy.ndarray(image.shape, dtype=numpy.uint8, buffer=shm.buf, offset=offset)[...] = image
+                chips.append({'shm': shm.name, 'offset': offset, 'shape': list(image.shape)})
+                offset += image.nbytes
+            reply = self.request({
+                'op': 'detect', 'model': self.model_path, 'options': self.options,
+                'chips': chips, 'detect_kwargs': detect_kwargs,
+            })
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        return [
+            (
+                numpy.array(d['xyxy'], dtype=numpy.float32).reshape((-1, 4)),
+                numpy.array(d['conf'], dtype=numpy.float32),
+                numpy.array(d['cls'], dtype=numpy.int32),
+            ) for d in reply['detections']
+        ]
+
+def load_model(path_to_tower_model_file, config=dict()):
+    """
+    Loads the tower model with the inference_backend selected in config: "ultralytics" (the default) runs the .pt file in PyTorch,
+    "onnxruntime" and "openvino" export it to ONNX first (see onnx_backend.py) and run that with inference_threads threads,
+    quantized to INT8 when inference_int8 is set. With inference_daemon set the model is loaded (once) by inference_daemon.py instead.
+    """
+    if config.get('inference_daemon', False):
+        return RemoteModel(path_to_tower_model_file, config)
+    backend = config.get('inference_backend', 'ultralytics')
+    if backend == 'ultralytics':
+        import ultralytics
+        return ultralytics.YOLO(path_to_tower_model_file)
+    import onnx_backend
+    return onnx_backend.load(
+        path_to_tower_model_file, backend=backend,
+        threads=int(config.get('inference_threads', 0)), int8=bool(config.get('inference_int8', False)),
+    )
+
+def config_detect_kwargs(config):
+    """
+    The detect() keyword arguments selected by a world-current.py config.
+    """
+    kwargs = dict(
+        sliced=bool(config.get('inference_sliced', False)), use_cache=bool(config.get('inference_cache', True)),
+        prefilter=float(config.get('inference_prefilter', 0)),
+    )
+    if kwargs['sliced']:
+        kwargs['overlap'] = float(config.get('inference_slice_overlap', DEFAULT_SLICE_OVERLAP))
+        if 'inference_slice_px' in config:
+            kwargs['slice_px'] = int(config['inference_slice_px'])
+    return kwargs
+
+def detection_boxes(yolo_model, detections):
+    """
+    Returns a list of (label, xyxy list, conf) for one image's (xyxy, conf, cls).
+    """
+    xyxy, conf, cls = detections
+    return [ (yolo_model.names[int(c)], [float(v) for v in box], float(p)) for box, p, c in zip(xyxy, conf, cls) ]
@@ -0,0 +1,188 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "ultralytics",
+#   "onnx",
+#   "onnxruntime",
+#   "diskcache",
+#   "platformdirs",
+#   "numpy"
+# ]
+# ///
+
+# Long-lived inference service; started on demand by inference.RemoteModel or by hand:
+#   uv run inference_daemon.py [--socket ./path/to/inference.sock] [--max-batch 16] [--max-latency-ms 25]
+
+# Importing torch and loading a .pt file takes seconds, which dominates short jobs. The daemon keeps every model it
+# was asked for loaded, keyed by the sha256 of the model file and how it is run, and listens on a Unix socket.
+# Clients put chips in shared memory (see chip_buffer.py) and send only their location; requests for the same model from any number of
+# clients are gathered into one batch until max-batch chips are waiting or the oldest waited max-latency-ms.
+
+import os
+import sys
+import time
+import queue
+import threading
+import traceback
+import socketserver
+import concurrent.futures
+
+import numpy
+
+sys.path.append(os.path.dirname(__file__))
+import inference
+import chip_buffer
+
+DEFAULT_MAX_BATCH = 16
+DEFAULT_MAX_LATENCY_S = 0.025
+
+class Batcher:
+    """
+    Owns one loaded model and a thread feeding it batches of queued chips.
+    """
+    def __init__(self, model, max_batch, max_latency_s):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_latency_s = max_latency_s
+        self.queue = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, images, detect_kwargs):
+        future = concurrent.futures.Future()
+        self.queue.put( (images, detect_kwargs, future) )
+        return future
+
+    def next_batch(self):
+        """
+        Waits for a request, then gathers more requests with the same detect arguments until max_batch chips are waiting
+        or max_latency_s passed. Requests with other arguments are put back for the next batch.
+        """
+        batch = [ self.queue.get() ]
+        num_images = len(batch[0][0])
+        deadline = time.monotonic() + self.max_latency_s
+        put_back = []
+        while num_images < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item[1] == batch[0][1]:
+                batch.append(item)
+                num_images += len(item[0])
+            else:
+                put_back.append(item)
+        for item in put_back:
+            self.queue.put(item)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            images = [image for item in batch for image in item[0]]
+            futures = [ (len(item[0]), item[2]) for item in batch ]
+            try:
+                detections = inference.detect(self.model, images, **batch[0][1])
+                error = None
+            except Exception as e:
+                traceback.print_exc()
+                error = f'{type(e).__name__}: {e}'
+            # Drop every view into the clients' shared memory before waking them, they close it right after
+            num_images = len(images)
+            del batch, images
+            if error is not None:
+                for num_item_images, future in futures:
+                    future.set_exception(RuntimeError(error))
+                continue
+            print(f'Scored {num_images} chips from {len(futures)} requests')
+            start = 0
+            for num_item_images, future in futures:
+                future.set_result(detections[start:start + num_item_images])
+                start += num_item_images
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, max_batch=DEFAULT_MAX_BATCH, max_latency_s=DEFAULT_MAX_LATENCY_S):
+        self.max_batch = max_batch
+        self.max_latency_s = max_latency_s
+        self.batchers = dict() # (model file sha256, options) -> Batcher
+        self.batchers_lock = threading.Lock()
+        super().__init__(socket_path, InferenceHandler)
+
+    def batcher(self, model_path, options):
+        key = (inference.file_fingerprint(model_path), tuple(sorted(options.items())))
+        with self.batchers_lock:
+            if not key in self.batchers:
+                print(f'Loading {model_path} with {options}')
+                self.batchers[key] = Batcher(inference.load_model(model_path, options), self.max_batch, self.max_latency_s)
+            return key[0], self.batchers[key]
+
+class InferenceHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            message = inference.recv_message(self.request)
+            if message is None:
+                return
+            try:
+                reply = self.reply(message)
+            except Exception as e:
+                traceback.print_exc()
+                reply = {'error': f'{type(e).__name__}: {e}'}
+            inference.send_message(self.request, reply)
+
+    def reply(self, message):
+        model_hash, batcher = self.server.batcher(message['model'], inference.model_options(message['options']))
+        if message['op'] == 'load':
+            return {
+                'model_hash': model_hash,
+                'names': {int(k): v for k, v in batcher.model.names.items()},
+                'imgsz': inference.model_imgsz(batcher.model),
+            }
+        if message['op'] != 'detect':
+            raise ValueError(f'Unknown op {message["op"]}')
+
+        blocks = dict()
+        images = []
+        try:
+            for chip in message['chips']:
+                if not chip['shm'] in blocks:
+                    blocks[chip['shm']] = chip_buffer.attach_shared_memory(chip['shm'])
+                images.append(numpy.ndarray(tuple(chip['shape']), dtype=numpy.uint8, buffer=blocks[chip['shm']].buf, offset=chip['offset']))
+            detections = batcher.submit(images, message['detect_kwargs']).result()
+        finally:
+            # Views into the blocks must be gone before they can be closed, also when the model failed
+            images = None
+            for shm in blocks.values():
+                try:
+                    shm.close()
+                except BufferError:
+                    pass # A view is still alive elsewhere; the mapping goes away with the last of them
+        return {'detections': [
+            {'xyxy': xyxy.tolist(), 'conf': conf.tolist(), 'cls': cls.tolist()} for xyxy, conf, cls in detections
+        ]}
+
+def serve(socket_path=inference.DAEMON_SOCKET_PATH, max_batch=DEFAULT_MAX_BATCH, max_latency_s=DEFAULT_MAX_LATENCY_S):
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with InferenceServer(socket_path, max_batch=max_batch, max_latency_s=max_latency_s) as server:
+        print(f'Inference daemon listening on {socket_path} (max batch {max_batch}, max latency {int(max_latency_s * 1000)}ms)')
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    def arg_value(name, default):
+        if name in args:
+            return args[args.index(name) + 1]
+        return default
+    serve(
+        socket_path=arg_value('--socket', inference.DAEMON_SOCKET_PATH),
+        max_batch=int(arg_value('--max-batch', DEFAULT_MAX_BATCH)),
+        max_latency_s=float(arg_value('--max-latency-ms', DEFAULT_MAX_LATENCY_S * 1000)) / 1000.0,
+    )
@@ -1,14 +1,21 @@
+import os
 import math
+import time
+import threading
+import traceback
+import collections
+import concurrent.futures
 from io import BytesIO
+from urllib.parse import urlparse
 
+import numpy
 import requests
+import requests.adapters
 from PIL import Image
 
-import diskcache
-import platformdirs
-
-chip_cache = diskcache.Cache(platformdirs.user_cache_dir('world-current'))
-CACHE_EXPIRE_S = 24 * 60 * 60
+import tile_store
+import projection
+import chip_buffer
 
 TILE_SIZE = 256
 ZOOM = 18  # Updated zoom level
@@ -16,6 +23,53 @@ ZOOM = 18  # Updated zoom level
 # Example XYZ tile server URL (OpenStreetMap)
 #TILE_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
 TILE_URL = "https://services.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
+# Folder name TILE_URL's tiles are kept under in tile_store; change it together with TILE_URL
+TILE_LAYER = 'world-imagery'
+
+# Tile servers throttle clients which open too many sockets, so every request to one host shares
+# at most this many keep-alive connections no matter how many chips are being stitched at once.
+MAX_CONNECTIONS_PER_HOST = 8
+HTTP_TIMEOUT_S = 30
+
+http_session = requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST, pool_block=True))
+http_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST, pool_block=True))
+
+host_semaphores = dict()
+host_semaphores_lock = threading.Lock()
+
+tile_fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONNECTIONS_PER_HOST * 2, thread_name_prefix='tile-fetch')
+
+# (layer, z, x, y) -> Future for every tile currently being downloaded; a second caller missing the same tile
+# waits on the first caller's download instead of starting its own (single-flight).
+inflight_tiles = dict()
+inflight_tiles_lock = threading.Lock()
+
+# Stitching from decoded tiles is a memcpy per tile rather than a JPEG decode per tile. The most recently used
+# DECODED_LRU_MAX_TILES (~192kb each) are kept in memory, until their tile's TTL runs out or it is downloaded again.
+# With tile_store.tiles.store_decoded (imagery_cache_decoded) decoded pixels are also stored next to the tiles and
+# memory-mapped from there; that skips the decode across runs, but a .npy is ~10x the size of its JPEG, so the same
+# imagery_cache_max_gb then holds ~10x fewer tiles.
+DECODED_LRU_MAX_TILES = 2048
+
+decoded_lru = collections.OrderedDict()
+decoded_lru_lock = threading.Lock()
+
+def host_semaphore(url):
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+      if not host in host_semaphores:
+        host_semaphores[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+      return host_semaphores[host]
+
+def http_get(url):
+    """
+    GET url over the shared keep-alive session, blocking while MAX_CONNECTIONS_PER_HOST requests to the same host are in flight.
+    """
+    with host_semaphore(url):
+      response = http_session.get(url, timeout=HTTP_TIMEOUT_S)
+    response.raise_for_status()
+    return response.content
 
 def latlon_to_tile(lat, lon, zoom):
     lat_rad = math.radians(lat)
@@ -24,40 +78,196 @@ def latlon_to_tile(lat, lon, zoom):
     ytile = int((1.0 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
     return xtile, ytile
 
+def fetch_tile_bytes(layer, url_template, zoom, x, y, max_age_s=None):
+    """
+    Returns the encoded bytes of one tile from tile_store, downloading it from url_template first if it is missing or older than max_age_s.
+    """
+    content = tile_store.tiles.get(layer, zoom, x, y, max_age_s=max_age_s)
+    if content is not None:
+      return content
+
+    key = (layer, zoom, x, y)
+    with inflight_tiles_lock:
+      future = inflight_tiles.get(key, None)
+      is_leader = future is None
+      if is_leader:
+        future = concurrent.futures.Future()
+        inflight_tiles[key] = future
+    if not is_leader:
+      return future.result()
+
+    try:
+      # Another leader may have finished this tile between our miss and taking the lock
+      content = tile_store.tiles.get(layer, zoom, x, y, max_age_s=max_age_s, track=False)
+      if content is None:
+        url = url_template.format(z=zoom, x=x, y=y)
+        #print(f'Downloading Image {url}')
+        content = http_get(url)
+        tile_store.tiles.put(layer, zoom, x, y, content)
+        if layer == TILE_LAYER:
+          # Decoded pixels of the tile it replaces are stale now
+          with decoded_lru_lock:
+            decoded_lru.pop((zoom, x, y), None)
+      future.set_result(content)
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    finally:
+      with inflight_tiles_lock:
+        inflight_tiles.pop(key, None)
+    return content
+
+def download_tile_bytes(x, y, zoom):
+    return fetch_tile_bytes(TILE_LAYER, TILE_URL, zoom, x, y)
+
 def download_tile(x, y, zoom):
-    url = TILE_URL.format(z=zoom, x=x, y=y)
-    #print(f'Downloading Image {url}')
-    content = chip_cache.get(url, None)
-    if content is None:
-      response = requests.get(url)
-      response.raise_for_status()
-      content = response.content
-      chip_cache.set(url, content)
-    return Image.open(BytesIO(content))
+    return Image.open(BytesIO(download_tile_bytes(x, y, zoom)))
+
+def download_tiles(xys, zoom):
+    """
+    Returns a dict of (x, y) -> encoded tile bytes for every tile in xys. Tiles already in tile_store are read
+    directly, the missing ones are fetched in parallel on tile_fetch_pool so the call takes about as long as the slowest tile.
+    """
+    tiles = dict()
+    pending = dict()
+    for x, y in xys:
+        content = tile_store.tiles.get(TILE_LAYER, zoom, x, y)
+        if content is None:
+          pending[(x, y)] = tile_fetch_pool.submit(download_tile_bytes, x, y, zoom)
+        else:
+          tiles[(x, y)] = content
+    for xy, future in pending.items():
+        tiles[xy] = future.result()
+    return tiles
+
+def decode_tile(content):
+    return numpy.asarray(Image.open(BytesIO(content)).convert('RGB'))
+
+def decoded_lru_get(key):
+    with decoded_lru_lock:
+      entry = decoded_lru.get(key, None)
+      if entry is None:
+        return None
+      pixels, expires_at = entry
+      if time.time() > expires_at:
+        del decoded_lru[key]
+        return None
+      decoded_lru.move_to_end(key)
+    # Served from memory, but still a hit of the stored tile (and keeps it from being evicted while in use)
+    tile_store.tiles.record_access((TILE_LAYER, *key), True)
+    return pixels
+
+def decoded_lru_put(key, pixels):
+    """
+    Keeps the decoded pixels of (zoom, x, y) in memory until the stored tile they came from expires.
+    """
+    zoom, x, y = key
+    try:
+      fetched_at = os.stat(tile_store.tiles.path(TILE_LAYER, zoom, x, y)).st_mtime
+    except FileNotFoundError:
+      fetched_at = time.time()
+    with decoded_lru_lock:
+      decoded_lru[key] = (pixels, fetched_at + tile_store.tiles.ttl_s(zoom))
+      decoded_lru.move_to_end(key)
+      while len(decoded_lru) > DECODED_LRU_MAX_TILES:
+        decoded_lru.popitem(last=False)
+
+def download_decoded_tile(x, y, zoom):
+    """
+    Returns one tile as a (TILE_SIZE, TILE_SIZE, 3) uint8 array, decoding it on first use (and storing the pixels in
+    tile_store when it stores decoded tiles).
+    """
+    key = (zoom, x, y)
+    pixels = decoded_lru_get(key)
+    if pixels is None:
+      store_decoded = tile_store.tiles.store_decoded
+      pixels = tile_store.tiles.get_decoded(TILE_LAYER, zoom, x, y) if store_decoded else None
+      if pixels is None:
+        pixels = decode_tile(download_tile_bytes(x, y, zoom))
+        if store_decoded:
+          tile_store.tiles.put_decoded(TILE_LAYER, zoom, x, y, pixels)
+      decoded_lru_put(key, pixels)
+    return pixels
+
+def download_decoded_tiles(xys, zoom):
+    """
+    Like download_tiles but returns decoded pixels; tiles which still have to be fetched or decoded are done in parallel on tile_fetch_pool.
+    """
+    tiles = dict()
+    pending = dict()
+    for x, y in xys:
+        pixels = decoded_lru_get((zoom, x, y))
+        if pixels is None:
+          pending[(x, y)] = tile_fetch_pool.submit(download_decoded_tile, x, y, zoom)
+        else:
+          tiles[(x, y)] = pixels
+    for xy, future in pending.items():
+        tiles[xy] = future.result()
+    return tiles
+
+def prefetch_tiles(xys, zoom):
+    """
+    Makes sure every tile in xys is in tile_store, downloading each missing tile exactly once.
+    Unlike download_tiles nothing is held in memory, so this may be given every tile of a whole region.
+    Returns the number of tiles which had to be downloaded.
+    """
+    pending = [
+        tile_fetch_pool.submit(download_tile_bytes, x, y, zoom) for x, y in set(xys) if not tile_store.tiles.contains(TILE_LAYER, zoom, x, y, track=False)
+    ]
+    for future in pending:
+        future.result()
+    return len(pending)
+
+def chip_tile_xys(center_x, center_y, tile_count=11):
+    half = tile_count // 2
+    return [
+        (x, y) for y in range(center_y - half, center_y + half + 1) for x in range(center_x - half, center_x + half + 1)
+    ]
+
+def stitch_tile_range_array(min_x, min_y, max_x, max_y, zoom, out=None):
+    """
+    Stitches every tile from min_x, min_y to max_x, max_y (inclusive) into out, a preallocated
+    ((max_y - min_y + 1) * TILE_SIZE, (max_x - min_x + 1) * TILE_SIZE, 3) uint8 array which is allocated when not given.
+    """
+    if out is None:
+      out = numpy.empty(((max_y - min_y + 1) * TILE_SIZE, (max_x - min_x + 1) * TILE_SIZE, 3), dtype=numpy.uint8)
+    xys = [(x, y) for y in range(min_y, max_y + 1) for x in range(min_x, max_x + 1)]
+    tiles = download_decoded_tiles(xys, zoom)
+    for (x, y), pixels in tiles.items():
+        px = (x - min_x) * TILE_SIZE
+        py = (y - min_y) * TILE_SIZE
+        out[py:py + pixels.shape[0], px:px + pixels.shape[1]] = pixels
+    return out
+
+def stitch_tiles_array(center_x, center_y, zoom, tile_count=11, out=None):
+    """
+    Stitches the tile_count x tile_count tiles around center_x, center_y into out, a preallocated
+    (TILE_SIZE * tile_count, TILE_SIZE * tile_count, 3) uint8 array which is allocated when not given.
+    """
+    half = tile_count // 2
+    return stitch_tile_range_array(center_x - half, center_y - half, center_x + half, center_y + half, zoom, out=out)
 
 def stitch_tiles(center_x, center_y, zoom, tile_count=11):
+    if tile_store.tiles.store_decoded:
+      return Image.fromarray(stitch_tiles_array(center_x, center_y, zoom, tile_count=tile_count))
+
     half = tile_count // 2
-    tiles = []
-    for y in range(center_y - half, center_y + half + 1):
-        row = []
-        for x in range(center_x - half, center_x + half + 1):
-            tile_img = download_tile(x, y, zoom)
-            row.append(tile_img)
-        tiles.append(row)
+    xys = chip_tile_xys(center_x, center_y, tile_count)
+    tiles = download_tiles(xys, zoom)
 
     stitched_width = TILE_SIZE * tile_count
     stitched_height = TILE_SIZE * tile_count
     final_img = Image.new('RGB', (stitched_width, stitched_height))
 
-    for row_idx, row in enumerate(tiles):
-        for col_idx, tile in enumerate(row):
-            final_img.paste(tile, (col_idx * TILE_SIZE, row_idx * TILE_SIZE))
+    for x, y in xys:
+        tile = Image.open(BytesIO(tiles[(x, y)]))
+        final_img.paste(tile, ((x - (center_x - half)) * TILE_SIZE, (y - (center_y - half)) * TILE_SIZE))
 
     return final_img
 
 def crop_to_1000m_area(image, lat, zoom, crop_size_m=1000):
     # Calculate meters per pixel at zoom and latitude
-    meters_per_pixel = 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom)
+    meters_per_pixel = projection.meters_per_pixel(lat, zoom)
     pixels_1000m = int(crop_size_m / meters_per_pixel)
 
     center_pixel = image.size[0] // 2
@@ -65,11 +275,132 @@ def crop_to_1000m_area(image, lat, zoom, crop_size_m=1000):
     return image.crop((center_pixel - half, center_pixel - half, center_pixel + half, center_pixel + half))
 
 
+def area_chip_tile_xys(lonx, laty):
+  return chip_tile_xys(*latlon_to_tile(laty, lonx, ZOOM), tile_count=11)
+
+def prefetch_area_chips(lonxs_latys, boost_s=None):
+  """
+  Downloads the union of the tiles needed by get_area_chip_image for every (lonx, laty) given, so overlapping chips
+  share their tiles instead of each one downloading them. Returns (number of unique tiles, number downloaded).
+  When boost_s is given the tiles are also boosted in tile_store so they outlive other tiles when evicting.
+  """
+  all_xys = set()
+  for lonx, laty in lonxs_latys:
+    all_xys.update(area_chip_tile_xys(lonx, laty))
+  num_downloaded = prefetch_tiles(all_xys, ZOOM)
+  if boost_s is not None:
+    tile_store.tiles.boost(TILE_LAYER, ZOOM, all_xys, boost_s)
+  return len(all_xys), num_downloaded
+
+def boost_area_chip(lonx, laty, boost_s):
+  tile_store.tiles.boost(TILE_LAYER, ZOOM, area_chip_tile_xys(lonx, laty), boost_s)
+
+def get_area_chip_array(lonx, laty, out=None):
+  """
+  Stitches the chip around lonx, laty straight into out (eg a chip_buffer.SharedChip's pixels) when given.
+  """
+  tile_x, tile_y = latlon_to_tile(laty, lonx, ZOOM)
+  return stitch_tiles_array(tile_x, tile_y, ZOOM, tile_count=11, out=out)
+
 def get_area_chip_image(lonx, laty):
   tile_x, tile_y = latlon_to_tile(laty, lonx, ZOOM)
   stitched_img = stitch_tiles(tile_x, tile_y, ZOOM, tile_count=11)
   #return crop_to_1000m_area(stitched_img, laty, ZOOM)
   return stitched_img
 
+class ScrollingMosaic:
+  """
+  A tile_count x tile_count chip which is moved to a new center in place: the tiles the old and new chip share are
+  shifted within the pixel buffer and only the newly exposed rows/columns of tiles are fetched.
+  Stepping one or two tiles along a line of towers touches tile_count to 2 * tile_count tiles instead of tile_count ** 2.
+  """
+  def __init__(self, zoom=ZOOM, tile_count=11, chip=None):
+    self.zoom = zoom
+    self.tile_count = tile_count
+    # When a chip_buffer.SharedChip is given the mosaic scrolls within its shared memory
+    self.chip = chip
+    if chip is None:
+      self.pixels = numpy.zeros((TILE_SIZE * tile_count, TILE_SIZE * tile_count, 3), dtype=numpy.uint8)
+    else:
+      self.pixels = chip.pixels
+    self.center = None # (tile x, tile y) currently held in pixels
+
+  def num_new_tiles(self, center_x, center_y):
+    if self.center is None:
+      return self.tile_count ** 2
+    overlap_x = max(0, self.tile_count - abs(center_x - self.center[0]))
+    overlap_y = max(0, self.tile_count - abs(center_y - self.center[1]))
+    return (self.tile_count ** 2) - (overlap_x * overlap_y)
+
+  def recenter(self, center_x, center_y):
+    """
+    Moves the mosaic to center on tile center_x, center_y and returns the pixel buffer, which is only valid until the next recenter.
+    """
+    if self.num_new_tiles(center_x, center_y) >= self.tile_count ** 2:
+      self.center = None
+      stitch_tiles_array(center_x, center_y, self.zoom, tile_count=self.tile_count, out=self.pixels)
+      self.center = (center_x, center_y)
+      return self.pixels
+
+    old_x, old_y = self.center
+    shift_x = (old_x - center_x) * TILE_SIZE # pixels moved right
+    shift_y = (old_y - center_y) * TILE_SIZE # pixels moved down
+    size = TILE_SIZE * self.tile_count
+    # numpy copes with the overlapping source and destination of the assignment
+    self.pixels[max(0, shift_y):size + min(0, shift_y), max(0, shift_x):size + min(0, shift_x)] = \
+      self.pixels[max(0, -shift_y):size + min(0, -shift_y), max(0, -shift_x):size + min(0, -shift_x)]
+    self.center = None # pixels are only partially valid until every new tile is in
+
+    half = self.tile_count // 2
+    old_xys = set(chip_tile_xys(old_x, old_y, self.tile_count))
+    new_xys = [xy for xy in chip_tile_xys(center_x, center_y, self.tile_count) if not xy in old_xys]
+    for (x, y), pixels in download_decoded_tiles(new_xys, self.zoom).items():
+      px = (x - (center_x - half)) * TILE_SIZE
+      py = (y - (center_y - half)) * TILE_SIZE
+      self.pixels[py:py + pixels.shape[0], px:px + pixels.shape[1]] = pixels
+    self.center = (center_x, center_y)
+    return self.pixels
+
+  def recenter_lonx_laty(self, lonx, laty):
+    return self.recenter(*latlon_to_tile(laty, lonx, self.zoom))
+
+def iter_area_chips(lonxs_latys, workers=4):
+  """
+  Yields (i, chip) for the i-th (lonx, laty) in lonxs_latys in completion order, stitching at most `workers` chips at once
+  straight into chip_buffer.SharedChips. The consumer hands each chip back with chip.release() once done with it;
+  new chips are only started as chips are released, so no more than 2 * workers chips are ever held in memory.
+  Chips are only valid until the iteration finishes. If a chip cannot be built the traceback is printed and (i, None) is yielded.
+  """
+  ring = chip_buffer.ChipRing(2 * workers, (TILE_SIZE * 11, TILE_SIZE * 11, 3))
+  def one_chip(i, lonx, laty):
+    chip = ring.acquire()
+    try:
+      get_area_chip_array(lonx, laty, out=chip.pixels)
+      return i, chip
+    except:
+      traceback.print_exc()
+      chip.release()
+      return i, None
+
+  work = iter(enumerate(lonxs_latys))
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chip') as pool:
+      pending = set()
+      def submit_next():
+        for i, (lonx, laty) in work:
+          pending.add(pool.submit(one_chip, i, lonx, laty))
+          return
+
+      for _ in range(workers):
+        submit_next()
+      while len(pending) > 0:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          yield future.result()
+          submit_next()
+  finally:
+    ring.free()
+
+
 
 
@@ -0,0 +1,190 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "ultralytics",
+#   "onnx",
+#   "onnxruntime",
+#   "opencv-python",
+#   "numpy"
+# ]
+# ///
+
+# Designed to be imported by inference.py; run stand-alone to export a tower model ahead of time:
+#   uv run onnx_backend.py ./path/to/best.pt [--int8]
+
+# CPU-only hosts spend most of a run in eager PyTorch. This exports the tower model to ONNX once and runs the
+# exported graph in a persistent ONNX Runtime (or OpenVINO) session instead. Pre- and post-processing mirror
+# what ultralytics does for the same model so boxes come out the same as from ultralytics.YOLO(...):
+# letterbox with gray (114) padding (only up to the next multiple of the stride when every image in a batch has the
+# same shape, like ultralytics' rect inference; to a full imgsz square otherwise), the BGR -> RGB flip ultralytics applies to numpy inputs (it assumes cv2 order),
+# conf > 0.25, per-class IoU 0.7 NMS and at most 300 boxes per image.
+
+import os
+import sys
+import json
+import math
+
+import numpy
+
+import inference
+
+BACKENDS = ('onnxruntime', 'openvino')
+CONF_THRESHOLD = 0.25
+NMS_IOU = 0.7
+MAX_DET = 300
+MAX_NMS = 30000
+STRIDE = 32
+
+def exported_paths(pt_file, int8=False):
+    """
+    Returns (.onnx path, sidecar .json path) of the export of pt_file.
+    """
+    stem = os.path.splitext(pt_file)[0]
+    onnx_file = f'{stem}.int8.onnx' if int8 else f'{stem}.onnx'
+    return onnx_file, f'{stem}.onnx.json'
+
+def is_current(path, pt_file):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(pt_file)
+
+def export(pt_file, int8=False):
+    """
+    Exports pt_file to ONNX next to it (with a dynamic batch dimension) unless an up to date export exists,
+    and with int8 also writes a dynamically quantized copy. Returns the path of the .onnx file to load.
+    """
+    onnx_file, meta_file = exported_paths(pt_file)
+    if not is_current(onnx_file, pt_file) or not is_current(meta_file, pt_file):
+        import ultralytics
+        yolo_model = ultralytics.YOLO(pt_file)
+        imgsz = STRIDE * math.ceil(inference.model_imgsz(yolo_model) / STRIDE)
+        print(f'Exporting {pt_file} to {onnx_file} at imgsz={imgsz}')
+        exported = yolo_model.export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+        if os.path.abspath(exported) != os.path.abspath(onnx_file):
+            os.replace(exported, onnx_file)
+        with open(meta_file, 'w') as fd:
+            json.dump({'imgsz': imgsz, 'names': {int(k): v for k, v in yolo_model.names.items()}}, fd)
+
+    if not int8:
+        return onnx_file
+    int8_file, meta_file = exported_paths(pt_file, int8=True)
+    if not is_current(int8_file, onnx_file):
+        import onnxruntime.quantization
+        print(f'Quantizing {onnx_file} to {int8_file}')
+        onnxruntime.quantization.quantize_dynamic(onnx_file, int8_file, weight_type=onnxruntime.quantization.QuantType.QUInt8)
+    return int8_file
+
+def letterbox(image, imgsz, auto=False):
+    """
+    Resizes image to fit in imgsz x imgsz keeping its aspect ratio and pads the rest gray, like ultralytics' LetterBox.
+    With auto only pads each side up to a multiple of STRIDE, which leaves non-square images rectangular.
+    """
+    import cv2
+    h, w = image.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * r)), int(round(h * r))
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    dw, dh = imgsz - new_w, imgsz - new_h
+    if auto:
+        dw, dh = dw % STRIDE, dh % STRIDE
+    dw, dh = dw / 2, dh / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+def preprocess(images, imgsz):
+    same_shapes = len(set(image.shape for image in images)) == 1
+    batch = numpy.stack([letterbox(image, imgsz, auto=same_shapes) for image in images])
+    # ultralytics treats numpy images as BGR and flips them to RGB before the model sees them
+    batch = batch[..., ::-1].transpose((0, 3, 1, 2))
+    return numpy.ascontiguousarray(batch, dtype=numpy.float32) / 255.0
+
+def postprocess(prediction, image_shapes, input_shape):
+    """
+    Turns the (batch, 4 + num classes, anchors) model output for (input height, input width) letterboxed images into
+    a list of (xyxy, conf, cls) in each original image's pixels.
+    """
+    input_h, input_w = input_shape
+    detections = []
+    for p, (h, w) in zip(prediction, image_shapes):
+        p = p.T
+        scores = p[:, 4:]
+        cls = scores.argmax(axis=1).astype(numpy.int32)
+        conf = scores[numpy.arange(len(scores)), cls].astype(numpy.float32)
+        candidates = numpy.nonzero(conf > CONF_THRESHOLD)[0]
+        candidates = candidates[numpy.argsort(-conf[candidates], kind='stable')][:MAX_NMS]
+        if len(candidates) < 1:
+            detections.append(inference.empty_detections())
+            continue
+        cx, cy, bw, bh = (p[candidates, k] for k in range(4))
+        xyxy = numpy.stack([cx - bw / 2, cy - bh / 2, cx + bw / 2, cy + bh / 2], axis=1).astype(numpy.float32)
+        conf = conf[candidates]
+        cls = cls[candidates]
+        keep = inference.nms(xyxy, conf, cls, iou=NMS_IOU, ios=None)[:MAX_DET]
+        xyxy, conf, cls = xyxy[keep], conf[keep], cls[keep]
+
+        # Undo the letterbox
+        gain = min(input_h / h, input_w / w)
+        pad_x = round((input_w - w * gain) / 2 - 0.1)
+        pad_y = round((input_h - h * gain) / 2 - 0.1)
+        xyxy = (xyxy - numpy.array([pad_x, pad_y, pad_x, pad_y], dtype=numpy.float32)) / gain
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, w)
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, h)
+        detections.append( (xyxy, conf, cls) )
+    return detections
+
+class ExportedModel:
+    """
+    Runs an exported tower model in one persistent session. Has the names and imgsz attributes of an ultralytics.YOLO
+    and a detect_arrays method inference.detect calls instead of the model itself.
+    """
+    def __init__(self, onnx_file, meta_file, backend='onnxruntime', threads=0):
+        if not backend in BACKENDS:
+            raise ValueError(f'Unknown inference backend {backend}, expected one of {BACKENDS}')
+        with open(meta_file, 'r') as fd:
+            meta = json.load(fd)
+        self.imgsz = int(meta['imgsz'])
+        self.names = {int(k): v for k, v in meta['names'].items()}
+        self.backend = backend
+        self.model_file = onnx_file
+        threads = int(threads) if threads else os.cpu_count()
+
+        if backend == 'onnxruntime':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = onnxruntime.InferenceSession(onnx_file, sess_options=options, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+        else:
+            import openvino
+            self.session = openvino.Core().compile_model(onnx_file, 'CPU', {'INFERENCE_NUM_THREADS': threads, 'PERFORMANCE_HINT': 'THROUGHPUT'})
+        print(f'Loaded {onnx_file} into {backend} with {threads} threads')
+
+    def run(self, batch):
+        if self.backend == 'onnxruntime':
+            return self.session.run(None, {self.input_name: batch})[0]
+        return self.session(batch)[self.session.output(0)]
+
+    def detect_arrays(self, images, imgsz=None):
+        """
+        Returns a list of (xyxy, conf, cls) for images, a list of HxWx3 uint8 arrays. imgsz is fixed at export time and ignored.
+        """
+        if len(images) < 1:
+            return []
+        batch = preprocess(images, self.imgsz)
+        return postprocess(self.run(batch), [image.shape[:2] for image in images], batch.shape[2:])
+
+def load(pt_file, backend='onnxruntime', threads=0, int8=False):
+    """
+    Exports pt_file if needed and returns an ExportedModel running it.
+    """
+    onnx_file = export(pt_file, int8=int8)
+    return ExportedModel(onnx_file, exported_paths(pt_file)[1], backend=backend, threads=threads)
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) != 1:
+        print(f'Usage: uv run onnx_backend.py ./path/to/best.pt [--int8]')
+        sys.exit(1)
+    print(f'Output {export(os.path.abspath(args[0]), int8="--int8" in sys.argv)}')
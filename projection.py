@@ -0,0 +1,99 @@
+
+# Designed to be imported by world-current.py
+
+# Exact Web Mercator (EPSG:3857, the projection every XYZ tile server uses) conversions between lon/lat and
+# pixels. Every function accepts scalars or numpy arrays, so all the boxes found in a chip convert in one call.
+
+import math
+
+import numpy
+
+TILE_SIZE = 256
+EARTH_CIRCUMFERENCE_M = 40075016.68557849 # at the equator, WGS84 semi-major axis
+MAX_LATY = 85.05112877980659 # Web Mercator is square, latitudes beyond this are off the map
+
+def world_pixels(zoom):
+    """
+    Width and height in pixels of the whole world at zoom.
+    """
+    return TILE_SIZE * (2.0 ** zoom)
+
+def lonlat_to_global_pixel(lonx, laty, zoom):
+    """
+    Returns pixel coordinates of lonx, laty across the whole world at zoom, ie tile x = pixel x // TILE_SIZE.
+    """
+    lonx = numpy.asarray(lonx, dtype=numpy.float64)
+    lat_rad = numpy.radians(numpy.clip(numpy.asarray(laty, dtype=numpy.float64), -MAX_LATY, MAX_LATY))
+    world_px = world_pixels(zoom)
+    px = (lonx + 180.0) / 360.0 * world_px
+    py = (1.0 - (numpy.arcsinh(numpy.tan(lat_rad)) / math.pi)) / 2.0 * world_px
+    return px, py
+
+def global_pixel_to_lonlat(px, py, zoom):
+    px = numpy.asarray(px, dtype=numpy.float64)
+    py = numpy.asarray(py, dtype=numpy.float64)
+    world_px = world_pixels(zoom)
+    lonx = (px / world_px * 360.0) - 180.0
+    laty = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1.0 - (2.0 * py / world_px)))))
+    return lonx, laty
+
+def meters_per_pixel(laty, zoom):
+    """
+    Ground width of one pixel at laty; Web Mercator stretches pixels by 1 / cos(laty) away from the equator.
+    """
+    return EARTH_CIRCUMFERENCE_M * numpy.cos(numpy.radians(laty)) / world_pixels(zoom)
+
+class ChipGeo:
+    """
+    Georeferences an image stitched from whole tiles: pixel 0,0 of the image is the top-left corner of tile
+    min_tile_x, min_tile_y at zoom. Chips are always tile aligned, so the position a chip was requested for
+    lies somewhere in its center tile and not at the center pixel; use lonlat_to_pixels to find it.
+    """
+    def __init__(self, min_tile_x, min_tile_y, zoom, width_px, height_px):
+        self.min_tile_x = min_tile_x
+        self.min_tile_y = min_tile_y
+        self.zoom = zoom
+        self.width_px = width_px
+        self.height_px = height_px
+
+    @classmethod
+    def centered_on_tile(cls, center_x, center_y, zoom, tile_count=11):
+        """
+        The chip of tile_count x tile_count tiles around tile center_x, center_y as built by location_chipper.stitch_tiles.
+        """
+        half = tile_count // 2
+        return cls(center_x - half, center_y - half, zoom, tile_count * TILE_SIZE, tile_count * TILE_SIZE)
+
+    @classmethod
+    def from_tile_range(cls, min_x, min_y, max_x, max_y, zoom):
+        """
+        The chip built by location_chipper.stitch_tile_range_array for the same (inclusive) tile range.
+        """
+        return cls(min_x, min_y, zoom, (max_x - min_x + 1) * TILE_SIZE, (max_y - min_y + 1) * TILE_SIZE)
+
+    def origin_px(self):
+        return self.min_tile_x * TILE_SIZE, self.min_tile_y * TILE_SIZE
+
+    def pixels_to_lonlat(self, xs, ys):
+        origin_x, origin_y = self.origin_px()
+        return global_pixel_to_lonlat(origin_x + numpy.asarray(xs, dtype=numpy.float64), origin_y + numpy.asarray(ys, dtype=numpy.float64), self.zoom)
+
+    def lonlat_to_pixels(self, lonxs, latys):
+        origin_x, origin_y = self.origin_px()
+        px, py = lonlat_to_global_pixel(lonxs, latys, self.zoom)
+        return px - origin_x, py - origin_y
+
+    def boxes_to_lonlat(self, xyxys):
+        """
+        Returns an (N, 2) array of the lonx, laty of the center of every x0, y0, x1, y1 box in xyxys.
+        """
+        xyxys = numpy.asarray(xyxys, dtype=numpy.float64).reshape((-1, 4))
+        lonxs, latys = self.pixels_to_lonlat((xyxys[:, 0] + xyxys[:, 2]) / 2.0, (xyxys[:, 1] + xyxys[:, 3]) / 2.0)
+        return numpy.stack([lonxs, latys], axis=1)
+
+    def meters_per_pixel(self):
+        """
+        Ground width of one pixel at the chip's center row.
+        """
+        center_lonx, center_laty = self.pixels_to_lonlat(self.width_px / 2.0, self.height_px / 2.0)
+        return float(meters_per_pixel(center_laty, self.zoom))
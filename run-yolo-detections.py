@@ -4,6 +4,8 @@
 #   "setuptools",
 #   "ultralytics",
 #   "numpy",
+#   "diskcache",
+#   "platformdirs",
 #   "Pillow"
 # ]
 # ///
@@ -16,9 +18,11 @@ import json
 
 import PIL
 from PIL import Image, ImageDraw, ImageFont
-from ultralytics import YOLO
 import numpy
 
+sys.path.append(os.path.dirname(__file__))
+import inference
+
 def get_default_ttf_font(size=16):
     font_paths = [
         "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Linux
@@ -34,47 +38,45 @@ def get_default_ttf_font(size=16):
     return PIL.ImageFont.load_default()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print(f'Usage: uv run run-yolo-detections.py ./path/to/yolov8n.pt ./path/to/image.png [./path/to/another-image.png ...]')
+    # --sliced runs the model over overlapping windows of its training size instead of shrinking each whole image,
+    # --no-cache runs the model even for images it already scored,
+    # --daemon scores them in inference_daemon.py (started if needed) which keeps the model loaded between runs
+    sliced = '--sliced' in sys.argv
+    use_cache = not '--no-cache' in sys.argv
+    use_daemon = '--daemon' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg in ('--sliced', '--no-cache', '--daemon')]
+    if len(args) < 2:
+        print(f'Usage: uv run run-yolo-detections.py [--sliced] [--no-cache] [--daemon] ./path/to/yolov8n.pt ./path/to/image.png [./path/to/another-image.png ...]')
         sys.exit(1)
 
-    yolo_pt_file = os.path.abspath(sys.argv[1])
-    image_files = [os.path.abspath(arg) for arg in sys.argv[2:]]
+    yolo_pt_file = os.path.abspath(args[0])
+    image_files = [os.path.abspath(arg) for arg in args[1:]]
     print(f'yolo_pt_file = {yolo_pt_file}')
     print(f'image_files = {image_files}')
 
-    model = YOLO(yolo_pt_file)
+    model = inference.load_model(yolo_pt_file, {'inference_daemon': use_daemon})
     pil_images = [PIL.Image.open(file) for file in image_files]
 
     # Convert PIL images to NumPy format for YOLO
     numpy_array_images = [numpy.array(img) for img in pil_images]
 
     # Do the analysis!
-    results = model(numpy_array_images)
+    image_detections = inference.detect(model, numpy_array_images, sliced=sliced, use_cache=use_cache)
 
     font = get_default_ttf_font(24)
 
-    for i, result in enumerate(results):
+    for i, detections in enumerate(image_detections):
         print(f'Results for image {i} at {image_files[i]}:')
 
         annotated_img = pil_images[i].copy()
         draw = ImageDraw.Draw(annotated_img)
 
-        for box in result.boxes:
-            cls = int(box.cls[0])  # class index
-            label = model.names[cls]  # class name
-            xyxy = box.xyxy[0].tolist()  # bounding box coordinates
-            conf = float(box.conf[0])  # confidence score
-
+        for label, xyxy, conf in inference.detection_boxes(model, detections):
             print(f'  Label: {label}')
             print(f'  Bounding box (xyxy): {xyxy}')
             print(f'  Confidence: {conf}')
 
-
-            xyxy = box.xyxy[0].tolist()
             x1, y1, x2, y2 = map(int, xyxy)
-            label = model.names[int(box.cls[0])]
-            conf = float(box.conf[0])
             label_text = f"{label} {conf:.2f}"
 
             # Draw box
@@ -2,10 +2,12 @@
 # Designed to be imported by world-current, does not run stand-alone!
 
 import csv
+import json
 import math
 import os
 import sys
 
+import numpy
 import PIL
 import PIL.ImageFont
 import PIL.ImageColor
@@ -26,9 +28,94 @@ def pt_dist(p1, p2):
         ((p1[0] - p2[0])**2.0) + ((p1[1] - p2[1])**2.0)
     )
 
+EARTH_RADIUS_M = 6371008.8
+# GeoGrid cells are never smaller than this, so a 0 radius (only exact duplicates) works too
+MIN_GEOGRID_CELL_M = 0.01
+
+def haversine_m(lonx1, laty1, lonx2, laty2):
+    """
+    Great-circle distance in meters between two lon/lat points.
+    """
+    phi1 = math.radians(laty1)
+    phi2 = math.radians(laty2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lonx2 - lonx1)
+    a = (math.sin(d_phi / 2.0)**2.0) + (math.cos(phi1) * math.cos(phi2) * (math.sin(d_lambda / 2.0)**2.0))
+    return 2.0 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+def bearing_deg(lonx1, laty1, lonx2, laty2):
+    """
+    Initial great-circle bearing from the first point to the second, in degrees clockwise from north.
+    """
+    phi1 = math.radians(laty1)
+    phi2 = math.radians(laty2)
+    d_lambda = math.radians(lonx2 - lonx1)
+    y = math.sin(d_lambda) * math.cos(phi2)
+    x = (math.cos(phi1) * math.sin(phi2)) - (math.sin(phi1) * math.cos(phi2) * math.cos(d_lambda))
+    return math.degrees(math.atan2(y, x)) % 360.0
+
+def destination_point(lonx, laty, bearing, distance_m):
+    """
+    Returns the (lonx, laty) reached by travelling distance_m from lonx, laty along bearing (degrees clockwise from north).
+    """
+    phi1 = math.radians(laty)
+    lambda1 = math.radians(lonx)
+    theta = math.radians(bearing)
+    delta = distance_m / EARTH_RADIUS_M
+    phi2 = math.asin((math.sin(phi1) * math.cos(delta)) + (math.cos(phi1) * math.sin(delta) * math.cos(theta)))
+    lambda2 = lambda1 + math.atan2(math.sin(theta) * math.sin(delta) * math.cos(phi1), math.cos(delta) - (math.sin(phi1) * math.sin(phi2)))
+    return ((math.degrees(lambda2) + 540.0) % 360.0) - 180.0, math.degrees(phi2)
+
+class GeoGrid:
+    """
+    Spatial hash of lon/lat points. Points are bucketed into cubes cell_m meters wide in earth-centered x,y,z space,
+    which unlike lon/lat cells stay the same size at every latitude and across the antimeridian,
+    so finding everything within cell_m of a location only looks at the 27 surrounding buckets.
+    """
+    def __init__(self, cell_m):
+        if not cell_m >= 0:
+            raise ValueError(f'GeoGrid cell size must not be negative, got {cell_m}')
+        self.cell_m = max(cell_m, MIN_GEOGRID_CELL_M)
+        self.cells = dict()
+        self.num_points = 0
+
+    def __len__(self):
+        return self.num_points
+
+    def cell_of(self, lonx, laty):
+        lon = math.radians(lonx)
+        lat = math.radians(laty)
+        scale = EARTH_RADIUS_M / self.cell_m
+        return (
+            math.floor(math.cos(lat) * math.cos(lon) * scale),
+            math.floor(math.cos(lat) * math.sin(lon) * scale),
+            math.floor(math.sin(lat) * scale),
+        )
+
+    def add(self, lonx, laty, value=None):
+        self.cells.setdefault(self.cell_of(lonx, laty), []).append( (lonx, laty, value) )
+        self.num_points += 1
+
+    def nearby(self, lonx, laty, radius_m):
+        """
+        Returns a list of (distance_m, lonx, laty, value) for every point within radius_m (at most cell_m) of lonx, laty, nearest first.
+        """
+        cx, cy, cz = self.cell_of(lonx, laty)
+        found = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for p_lonx, p_laty, value in self.cells.get((cx + dx, cy + dy, cz + dz), ()):
+                        dist_m = haversine_m(lonx, laty, p_lonx, p_laty)
+                        if dist_m <= radius_m:
+                            found.append( (dist_m, p_lonx, p_laty, value) )
+        found.sort(key=lambda item: item[0])
+        return found
+
 def add_pixels_to_coordinates(lat, lon, pixels_north, pixels_east):
     """
     Add pixels to lat, lon coordinates and return the new lat, lon coordinates.
+    This is a flat-earth approximation with a fixed pixel size; projection.ChipGeo does exact Web Mercator conversions.
 
     Parameters:
     lat (float): The latitude in decimal degrees.
@@ -158,7 +245,7 @@ def load_geometries(input_data):
         else:
             try:
                 # Assume it's a WKT string
-                geom = shapely.wkt.load_wkt(input_data)
+                geom = shapely.wkt.loads(input_data)
                 if isinstance(geom, shapely.geometry.Polygon):
                     polygons.append(geom)
                 else:
@@ -170,15 +257,38 @@ def load_geometries(input_data):
 
     # Compute overall bounding box
     if polygons:
-        combined = shapely.geometry.box(*polygons[0].bounds)
-        for poly in polygons[1:]:
-            combined = combined.union(shapely.geometry.box(*poly.bounds))
-        bounding_box = combined.bounds
+        bounding_box = tuple(float(v) for v in shapely.total_bounds(polygons))
     else:
         bounding_box = None
 
     return polygons, bounding_box
 
+def points_in_polygons(polygons, lonxs, latys, strtree_min_polygons=32):
+    """
+    Vectorized point-in-polygon test of many points against a region made of many polygons.
+
+    Returns a boolean numpy array which is True where (lonxs[i], latys[i]) lies inside or on the edge of any polygon.
+    Small regions test every point against each prepared polygon; regions of strtree_min_polygons or more polygons
+    are indexed with an STRtree so each point is only tested against the polygons whose bounds contain it.
+    """
+    lonxs = numpy.asarray(lonxs, dtype=numpy.float64)
+    latys = numpy.asarray(latys, dtype=numpy.float64)
+    inside = numpy.zeros(lonxs.shape, dtype=bool)
+    if len(polygons) < 1 or len(lonxs) < 1:
+        return inside
+
+    if len(polygons) < strtree_min_polygons:
+        for polygon in polygons:
+            shapely.prepare(polygon)
+            outside = ~inside
+            inside[outside] = shapely.intersects_xy(polygon, lonxs[outside], latys[outside])
+        return inside
+
+    tree = shapely.STRtree(polygons)
+    point_indices, _ = tree.query(shapely.points(lonxs, latys), predicate='intersects')
+    inside[point_indices] = True
+    return inside
+
 def calculate_zoom(min_lon, min_lat, max_lon, max_lat, width_px, height_px):
     """Estimate zoom level that fits the bounding box in the given pixel dimensions."""
     WORLD_DIM = {'height': 256, 'width': 256}
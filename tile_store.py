@@ -0,0 +1,373 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "numpy",
+#   "platformdirs"
+# ]
+# ///
+
+# Designed to be imported by location_chipper.py and analytic_tile_server.py; run stand-alone to inspect the store:
+#   uv run tile_store.py stats
+#   uv run tile_store.py evict
+
+# Imagery tiles are kept as plain files laid out as <root>/<layer>/<z>/<x // 256>/<x>/<y>.tile rather than
+# inside diskcache, so readers never take a lock, the server can sendfile() them straight to a socket
+# and small values cached by world-current.py no longer share a SQLite database with gigabytes of tiles.
+# A separate SQLite index records the size, fetch time and last access of every tile for eviction.
+# Next to a tile an optional <y>.npy may hold its decoded uint8 RGB pixels, which callers memory-map
+# instead of decoding the JPEG/PNG again; they are only written when store_decoded is set (imagery_cache_decoded).
+
+import os
+import sys
+import time
+import atexit
+import sqlite3
+import tempfile
+import threading
+
+import numpy
+import platformdirs
+
+X_SHARD = 256
+
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024 * 1024
+# Once over budget we evict down to this fraction of it, so eviction does not run again on the very next put
+EVICT_TO_FRACTION = 0.9
+
+# Satellite imagery at the zoom levels we chip at changes rarely, overview tiles are cheap to re-fetch
+DEFAULT_TTL_S = 7 * 24 * 60 * 60
+DEFAULT_ZOOM_TTL_S = {
+    z: 90 * 24 * 60 * 60 for z in range(15, 23)
+}
+
+# Tiles are evicted in order of last access + boost, so boosted tiles survive that much longer than unboosted ones.
+# A boost lasts that long after the tile was last boosted; after that the tile is evicted like any other.
+FACILITY_BOOST_S = 30 * 24 * 60 * 60
+FOLLOW_PATH_BOOST_S = 7 * 24 * 60 * 60
+
+# Accesses are recorded in memory and written to the index in batches of this many
+ACCESS_FLUSH_EVERY = 512
+
+class TileStore:
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, zoom_ttl_s=None, store_decoded=False):
+        self.root = root
+        self.store_decoded = store_decoded
+        self.index_path = os.path.join(root, 'index.sqlite3')
+        self.local = threading.local()
+        self.max_bytes = max_bytes
+        self.zoom_ttl_s = dict(DEFAULT_ZOOM_TTL_S)
+        if zoom_ttl_s is not None:
+            self.zoom_ttl_s.update(zoom_ttl_s)
+
+        self.lock = threading.Lock()
+        self.accessed = dict()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(root, exist_ok=True)
+        self.db().execute('''
+            CREATE TABLE IF NOT EXISTS tiles (
+                layer TEXT NOT NULL, z INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL,
+                size INTEGER NOT NULL, fetched_at REAL NOT NULL,
+                PRIMARY KEY (layer, z, x, y)
+            )
+        ''')
+        columns = [row[1] for row in self.db().execute('PRAGMA table_info(tiles)')]
+        for column, definition in [
+            ('decoded_size', 'INTEGER NOT NULL DEFAULT 0'), ('last_access', 'REAL NOT NULL DEFAULT 0'),
+            ('boost_s', 'REAL NOT NULL DEFAULT 0'), ('boost_until', 'REAL NOT NULL DEFAULT 0'),
+        ]:
+            if not column in columns:
+                self.db().execute(f'ALTER TABLE tiles ADD COLUMN {column} {definition}')
+        self.db().execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        # Every process using the store (follow workers, the inference daemon, ...) adds to this shared total
+        self.db().execute(
+            "INSERT OR IGNORE INTO stats (name, value) SELECT 'occupied_bytes', COALESCE(SUM(size + decoded_size), 0) FROM tiles"
+        )
+        atexit.register(self.flush)
+
+    def configure(self, max_bytes=None, zoom_ttl_s=None, store_decoded=None):
+        if store_decoded is not None:
+            self.store_decoded = store_decoded
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if zoom_ttl_s is not None:
+            self.zoom_ttl_s.update(zoom_ttl_s)
+
+    def ttl_s(self, z):
+        return self.zoom_ttl_s.get(z, DEFAULT_TTL_S)
+
+    def db(self):
+        # sqlite3 connections may not be shared between threads, so each thread opens its own
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def path(self, layer, z, x, y):
+        return os.path.join(self.root, layer, str(z), str(x // X_SHARD), str(x), f'{y}.tile')
+
+    def decoded_path(self, layer, z, x, y):
+        return os.path.join(self.root, layer, str(z), str(x // X_SHARD), str(x), f'{y}.npy')
+
+    def record_access(self, key, hit):
+        """
+        Counts a hit; misses are counted by put(), once per downloaded tile, as a miss is often looked up again before the download.
+        Callers keeping decoded tiles in memory (location_chipper) record their hits here too, so the hit rate covers every lookup
+        of a tile rather than only those reaching the disk. Existence checks which are followed by a read pass track=False.
+        """
+        if not hit:
+            return
+        with self.lock:
+            self.hits += 1
+            self.accessed[key] = time.time()
+            should_flush = len(self.accessed) >= ACCESS_FLUSH_EVERY
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes recorded accesses and hit/miss counts to the index.
+        """
+        with self.lock:
+            accessed, self.accessed = self.accessed, dict()
+            hits, misses = self.hits, self.misses
+            self.hits, self.misses = 0, 0
+        if len(accessed) < 1 and hits == 0 and misses == 0:
+            return
+        conn = self.db()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'UPDATE tiles SET last_access = MAX(last_access, ?) WHERE layer = ? AND z = ? AND x = ? AND y = ?',
+                [(t, *key) for key, t in accessed.items()]
+            )
+            for name, value in [('hits', hits), ('misses', misses)]:
+                conn.execute('INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, value))
+
+    def is_fresh(self, z, mtime, max_age_s):
+        if max_age_s is None:
+            max_age_s = self.ttl_s(z)
+        return time.time() - mtime <= max_age_s
+
+    def open(self, layer, z, x, y, max_age_s=None, track=True):
+        """
+        Returns an open binary file for the tile, or None if it is not stored or is older than max_age_s
+        (the store's TTL for zoom level z when not given).
+        """
+        try:
+            fd = open(self.path(layer, z, x, y), 'rb')
+        except FileNotFoundError:
+            fd = None
+        if fd is not None and not self.is_fresh(z, os.fstat(fd.fileno()).st_mtime, max_age_s):
+            fd.close()
+            fd = None
+        if track:
+            self.record_access((layer, z, x, y), fd is not None)
+        return fd
+
+    def get(self, layer, z, x, y, max_age_s=None, track=True):
+        fd = self.open(layer, z, x, y, max_age_s=max_age_s, track=track)
+        if fd is None:
+            return None
+        with fd:
+            return fd.read()
+
+    def contains(self, layer, z, x, y, max_age_s=None, track=True):
+        try:
+            found = self.is_fresh(z, os.stat(self.path(layer, z, x, y)).st_mtime, max_age_s)
+        except FileNotFoundError:
+            found = False
+        if track:
+            self.record_access((layer, z, x, y), found)
+        return found
+
+    def get_decoded(self, layer, z, x, y):
+        """
+        Returns the tile's decoded pixels as a read-only memory-mapped numpy array, or None if they were never stored
+        or the encoded tile they came from has expired.
+        """
+        if not self.contains(layer, z, x, y, track=False):
+            return None
+        try:
+            pixels = numpy.load(self.decoded_path(layer, z, x, y), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        self.record_access((layer, z, x, y), True)
+        return pixels
+
+    def put_decoded(self, layer, z, x, y, pixels):
+        def write(fd):
+            numpy.save(fd, numpy.ascontiguousarray(pixels, dtype=numpy.uint8))
+        path = self.decoded_path(layer, z, x, y)
+        atomic_write(path, write)
+        decoded_size = os.path.getsize(path)
+        self.db().execute(
+            'UPDATE tiles SET decoded_size = ? WHERE layer = ? AND z = ? AND x = ? AND y = ?',
+            (decoded_size, layer, z, x, y)
+        )
+        self.add_bytes(decoded_size)
+
+    def put(self, layer, z, x, y, content):
+        # Decoded pixels of the tile being replaced are stale now
+        try:
+            os.remove(self.decoded_path(layer, z, x, y))
+        except FileNotFoundError:
+            pass
+        atomic_write(self.path(layer, z, x, y), lambda fd: fd.write(content))
+        now = time.time()
+        conn = self.db()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            replaced = conn.execute(
+                'SELECT size + decoded_size FROM tiles WHERE layer = ? AND z = ? AND x = ? AND y = ?', (layer, z, x, y)
+            ).fetchone()
+            conn.execute(
+                'INSERT INTO tiles (layer, z, x, y, size, fetched_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(layer, z, x, y) DO UPDATE SET size = excluded.size, fetched_at = excluded.fetched_at, last_access = excluded.last_access, decoded_size = 0',
+                (layer, z, x, y, len(content), now, now)
+            )
+        with self.lock:
+            self.misses += 1
+        self.add_bytes(len(content) - (replaced[0] if replaced is not None else 0))
+
+    def boost(self, layer, z, xys, boost_s):
+        """
+        Makes the tiles in xys outlive un-boosted tiles by boost_s seconds of idle time before being evicted,
+        for the next boost_s seconds.
+        """
+        now = time.time()
+        conn = self.db()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'UPDATE tiles SET boost_s = CASE WHEN boost_until > ? THEN MAX(boost_s, ?) ELSE ? END, boost_until = MAX(boost_until, ?) '
+                'WHERE layer = ? AND z = ? AND x = ? AND y = ?',
+                [(now, boost_s, boost_s, now + boost_s, layer, z, x, y) for x, y in xys]
+            )
+
+    def occupied_bytes(self):
+        row = self.db().execute('SELECT COALESCE(SUM(size + decoded_size), 0) FROM tiles').fetchone()
+        return int(row[0])
+
+    def add_bytes(self, delta):
+        conn = self.db()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("UPDATE stats SET value = value + ? WHERE name = 'occupied_bytes'", (delta,))
+            total_bytes = conn.execute("SELECT value FROM stats WHERE name = 'occupied_bytes'").fetchone()[0]
+        if total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, target_bytes=None):
+        """
+        Deletes least-recently-used tiles (last access + boost) until the store holds at most target_bytes.
+        Returns the number of bytes freed.
+        """
+        if target_bytes is None:
+            target_bytes = int(self.max_bytes * EVICT_TO_FRACTION)
+        self.flush()
+        conn = self.db()
+        excess = self.occupied_bytes() - target_bytes
+        freed = 0
+        if excess > 0:
+            victims = []
+            for layer, z, x, y, size in conn.execute(
+                'SELECT layer, z, x, y, size + decoded_size FROM tiles ORDER BY last_access + CASE WHEN boost_until > ? THEN boost_s ELSE 0 END ASC',
+                (time.time(),)
+            ):
+                victims.append((layer, z, x, y))
+                freed += size
+                if freed >= excess:
+                    break
+            for layer, z, x, y in victims:
+                for path in [self.path(layer, z, x, y), self.decoded_path(layer, z, x, y)]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany('DELETE FROM tiles WHERE layer = ? AND z = ? AND x = ? AND y = ?', victims)
+        # Re-sync the shared total, which drifts when a process dies between writing a tile and counting it
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("UPDATE stats SET value = (SELECT COALESCE(SUM(size + decoded_size), 0) FROM tiles) WHERE name = 'occupied_bytes'")
+        return freed
+
+    def stats(self):
+        self.flush()
+        conn = self.db()
+        counters = dict(conn.execute('SELECT name, value FROM stats').fetchall())
+        return {
+            'max_bytes': self.max_bytes,
+            'occupied_bytes': self.occupied_bytes(),
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'layers': conn.execute(
+                'SELECT layer, z, COUNT(*), SUM(size), SUM(decoded_size), SUM(boost_until > ?) FROM tiles GROUP BY layer, z ORDER BY layer, z',
+                (time.time(),)
+            ).fetchall(),
+        }
+
+def atomic_write(path, write):
+    """
+    Calls write(fd) on a temporary file next to path and renames it over path, so readers only ever see complete files.
+    """
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(tmp_fd, 'wb') as fd:
+            write(fd)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def content_type(content):
+    if content.startswith(b'\x89PNG'):
+        return 'image/png'
+    elif content.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    return 'application/octet-stream'
+
+def configure_from_config(config):
+    """
+    Applies the imagery_cache_* keys of a world-current config.toml to the shared store.
+    """
+    max_bytes = None
+    if 'imagery_cache_max_gb' in config:
+        max_bytes = int(float(config['imagery_cache_max_gb']) * 1024 * 1024 * 1024)
+    zoom_ttl_s = None
+    if 'imagery_cache_zoom_ttl_days' in config:
+        zoom_ttl_s = {int(z): float(days) * 24 * 60 * 60 for z, days in config['imagery_cache_zoom_ttl_days'].items()}
+    store_decoded = None
+    if 'imagery_cache_decoded' in config:
+        store_decoded = bool(config['imagery_cache_decoded'])
+    tiles.configure(max_bytes=max_bytes, zoom_ttl_s=zoom_ttl_s, store_decoded=store_decoded)
+
+def gb(num_bytes):
+    return f'{num_bytes / (1024 * 1024 * 1024):.2f}gb'
+
+tiles = TileStore(os.path.join(platformdirs.user_cache_dir('world-current'), 'tiles'))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or not sys.argv[1] in ('stats', 'evict'):
+        print(f'Usage: uv run tile_store.py stats|evict')
+        sys.exit(1)
+
+    if sys.argv[1] == 'evict':
+        print(f'Freed {gb(tiles.evict())}')
+
+    stats = tiles.stats()
+    print(f'Tile store at {tiles.root}')
+    print(f'Occupied {gb(stats["occupied_bytes"])} of a {gb(stats["max_bytes"])} budget ({100.0 * stats["occupied_bytes"] / max(1, stats["max_bytes"]):.1f}%)')
+    lookups = stats['hits'] + stats['misses']
+    print(f'Hit rate {100.0 * stats["hits"] / max(1, lookups):.1f}% over {lookups:,} lookups')
+    for layer, z, count, size, decoded_size, boosted in stats['layers']:
+        print(f'  {layer} z{z}: {count:,} tiles ({boosted:,} boosted), {gb(size)} encoded + {gb(decoded_size)} decoded, ttl {tiles.ttl_s(z) / (24 * 60 * 60):.0f} days')
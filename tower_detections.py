@@ -0,0 +1,331 @@
+
+# Designed to be imported by inference.py and run-tower-detections.py
+
+# Classical (non-ML) tower detection, grown out of run-tower-detections.py: an Otsu threshold splits a chip into
+# dark and light regions, and towers and their shadows show up as short, thin, straight regions among them.
+#
+# line_structure_score counts such regions on a downsampled chip in a few milliseconds. Chips of open desert, water or
+# dense forest have next to none, so inference.detect can skip the tower model for them (inference_prefilter).
+#
+# detect_towers runs the whole run-tower-detections.py pipeline on one image: segments are found in the threshold,
+# redrawn and found again so fragments touching end to end meld into one, segments crossing much shorter or longer ones
+# are dropped, and the rest are grouped by length; a group of tower-sized segments spaced at only a few distinct
+# intervals is a line of towers. Results are cached by image hash; detect_folder runs it over a folder on a process pool.
+
+import os
+import math
+import random
+import hashlib
+import collections
+import multiprocessing
+
+import numpy
+import diskcache
+import platformdirs
+
+DEFAULT_PREFILTER_SCALE = 0.25
+DEFAULT_MIN_CONTRAST = 24.0 # gray levels between the mean of both sides of the threshold; below it Otsu only split noise or texture
+MIN_SEGMENT_PX = 16 # full resolution length of the shortest segment counted; towers are 16-48px at z18
+MAX_SEGMENT_PX = 200 # run-tower-detections.py drops longer "lines" too
+MAX_SEGMENT_WIDTH_PX = 2.5 # mean width, in downsampled pixels, of a region still counted as a line
+
+MIN_LINE_LENGTH_PX = 5
+MAX_LINE_PX = 200.0
+LINE_SIMILARITY_THRESHOLD = 0.50
+# Default lengths, in pixels, between which a line may be part of a tower; depends on the imagery resolution
+TOWER_LINE_MIN_PX = 16.0
+TOWER_LINE_MAX_PX = 48.0
+DEBUG_SCALE = 0.25
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+RESULTS_CACHE_DIR = platformdirs.user_cache_dir('tower-detections')
+RESULTS_CACHE_EXPIRE_S = 24 * 60 * 60
+results_cache = None
+
+def to_gray(image, scale=1.0, bgr=False):
+    """
+    Returns a uint8 grayscale copy of image (HxWx3 RGB, or BGR with bgr set, or HxW), resized by scale.
+    """
+    import cv2
+    image = numpy.asarray(image)
+    if scale != 1.0:
+        h, w = image.shape[:2]
+        image = cv2.resize(image, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if bgr else cv2.COLOR_RGB2GRAY)
+    return image
+
+def otsu_threshold(gray):
+    """
+    Marks the darker side of the Otsu threshold of gray with 255, like run-tower-detections.py.
+    """
+    import cv2
+    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return thresh
+
+def line_structure_score(image, scale=DEFAULT_PREFILTER_SCALE, min_contrast=DEFAULT_MIN_CONTRAST):
+    """
+    Returns how many short straight segments a chip (HxWx3 RGB) shows at scale; 0 means nothing line-like at all.
+    Every connected region of the thresholded chip is measured at once: a segment is a region whose bounding box diagonal
+    is between MIN_SEGMENT_PX and MAX_SEGMENT_PX (at full resolution) and whose area over that diagonal is at most
+    MAX_SEGMENT_WIDTH_PX, ie it is thin along its whole length.
+    """
+    import cv2
+    gray = to_gray(image, scale=scale)
+    thresh = otsu_threshold(gray)
+    dark = thresh > 0
+    if dark.all() or not dark.any() or float(gray[~dark].mean()) - float(gray[dark].mean()) < min_contrast:
+        return 0
+    _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+    stats = stats[1:] # label 0 is the background
+    lengths = numpy.hypot(stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT])
+    widths = stats[:, cv2.CC_STAT_AREA] / numpy.maximum(lengths, 1.0)
+    segments = (lengths >= MIN_SEGMENT_PX * scale) & (lengths < MAX_SEGMENT_PX * scale) & (widths <= MAX_SEGMENT_WIDTH_PX)
+    return int(numpy.count_nonzero(segments))
+
+def contour_lines(thresh, min_length=MIN_LINE_LENGTH_PX):
+    """
+    Finds the outer contours of thresh which simplify to 2-5 corners and returns (lines, contours, polygons):
+    an (N, 4) int32 array of x1, y1, x2, y2 per line (the bounding box of the polygon, flipped vertically when it rises
+    to the right), every contour, and the simplified polygon of each line.
+    """
+    import cv2
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    lines = []
+    polygons = []
+    for contour in contours:
+        length = cv2.arcLength(contour, True)
+        polygon = cv2.approxPolyDP(contour, 0.03 * length, True)
+        if not 2 <= len(polygon) <= 5:
+            continue
+        corners = polygon[:, 0, :]
+        x1, y1 = corners.min(axis=0)
+        x2, y2 = corners.max(axis=0)
+        # if x1, y1 is not near _any_ of the corners we flip the y1, y2 values (transpose to align w/ original coordinates)
+        if numpy.sqrt(((corners[:, 0] - x1) ** 2.0) + ((corners[:, 1] - y1) ** 2.0)).min() > 3.0:
+            y1, y2 = y2, y1
+        if length > min_length and math.sqrt(((x1 - x2) ** 2.0) + ((y1 - y2) ** 2.0)) < MAX_LINE_PX:
+            lines.append( (x1, y1, x2, y2) )
+            polygons.append(polygon)
+    return numpy.array(lines, dtype=numpy.int32).reshape((-1, 4)), contours, polygons
+
+def meld_lines(lines, shape):
+    """
+    Draws lines 2px wide on a black HxW image, joining fragments which overlap at their ends.
+    """
+    import cv2
+    melded = numpy.zeros(shape[:2], dtype=numpy.uint8)
+    for x1, y1, x2, y2 in lines.tolist():
+        cv2.line(melded, (x1, y1), (x2, y2), 255, 2)
+    return melded
+
+def line_lengths(lines):
+    lines = numpy.asarray(lines, dtype=numpy.float64).reshape((-1, 4))
+    return numpy.sqrt((lines[:, 2] - lines[:, 0]) ** 2 + (lines[:, 3] - lines[:, 1]) ** 2)
+
+def isolated_lines(lines, similarity=LINE_SIMILARITY_THRESHOLD):
+    """
+    Keeps the lines whose bounding box overlaps only lines within +-similarity of their own length.
+    Boxes are sorted by xmin; a box can only overlap boxes whose xmin is within the widest box's width to its left and
+    before its own xmax, so every line is compared with that window of the sort instead of with every other line.
+    """
+    lines = numpy.asarray(lines, dtype=numpy.int32).reshape((-1, 4))
+    if len(lines) < 1:
+        return lines
+    x1, y1, x2, y2 = (lines[:, k] for k in range(4))
+    xmin, ymin, xmax, ymax = numpy.minimum(x1, x2), numpy.minimum(y1, y2), numpy.maximum(x1, x2), numpy.maximum(y1, y2)
+    lengths = numpy.sqrt(((x1 - x2) ** 2.0 + ((y1 - y2) ** 2.0)))
+
+    order = numpy.argsort(xmin, kind='stable')
+    sorted_xmin = xmin[order]
+    max_width = int((xmax - xmin).max())
+    starts = numpy.searchsorted(sorted_xmin, xmin - max_width, side='right')
+    ends = numpy.searchsorted(sorted_xmin, xmax, side='left')
+    counts = numpy.maximum(ends - starts, 0)
+
+    # Every (line, candidate) pair of the windows, flattened
+    idx = numpy.repeat(numpy.arange(len(lines)), counts)
+    first_of_window = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    candidates = order[numpy.arange(len(idx)) - first_of_window + numpy.repeat(starts, counts)]
+    overlaps = (
+        (xmin[idx] < xmax[candidates]) & (xmin[candidates] < xmax[idx]) &
+        (ymin[idx] < ymax[candidates]) & (ymin[candidates] < ymax[idx])
+    )
+    idx, candidates = idx[overlaps], candidates[overlaps]
+
+    shortest = numpy.full(len(lines), numpy.inf)
+    longest = numpy.full(len(lines), -numpy.inf)
+    numpy.minimum.at(shortest, idx, lengths[candidates])
+    numpy.maximum.at(longest, idx, lengths[candidates])
+    # No overlapping lines at all keeps the line by definition
+    has_overlaps = numpy.bincount(idx, minlength=len(lines)) > 0
+    similar = (shortest >= (1.0 - similarity) * lengths) & (longest <= (1.0 + similarity) * lengths)
+    return lines[~has_overlaps | similar]
+
+def length_buckets(lines):
+    """
+    Sorts lines into buckets of lines within -25%/+25% of the same length. Returns {length of the first line: (N, 4) lines}.
+    """
+    buckets = dict()
+    for line, length in zip(lines, line_lengths(lines)):
+        for key in buckets:
+            if length * 0.75 <= key <= length * 1.25:
+                buckets[key].append(line)
+                break
+        else:
+            buckets[float(length)] = [line]
+    return {key: numpy.array(bucket, dtype=numpy.int32).reshape((-1, 4)) for key, bucket in buckets.items()}
+
+def extract_frequency(measurements, min_count=2):
+    """
+    Returns the sorted distinct rounded distances from each measurement to its nearest other measurement which
+    occur at least min_count (and at least twice).
+    """
+    differences = []
+    for i, a in enumerate(measurements):
+        min_dist = None
+        for j, b in enumerate(measurements):
+            if i != j and (min_dist is None or abs(a - b) < min_dist):
+                min_dist = abs(a - b)
+        if min_dist is not None and int(min_dist) > 0:
+            differences.append(min_dist)
+    counts = collections.Counter(numpy.round(differences))
+    return sorted(set(int(diff) for diff, count in counts.items() if count >= min_count and count > 1))
+
+def tower_line_groups(lines, tower_min_px=TOWER_LINE_MIN_PX, tower_max_px=TOWER_LINE_MAX_PX):
+    """
+    Returns [(lines, frequencies)] per bucket of tower-sized lines, ie longer than tower_min_px and shorter than tower_max_px; the lines of a bucket are towers when it has
+    between 1 and 4 frequencies, ie its lines repeat at only a few distinct spacings.
+    """
+    groups = []
+    for size_key, bucket in length_buckets(lines).items():
+        if not (tower_min_px < size_key < tower_max_px):
+            continue
+        # Distance is commutative, so the frequencies of the first line are those of every line in the bucket
+        cx, cy = (bucket[0, 0] + bucket[0, 2]) / 2.0, (bucket[0, 1] + bucket[0, 3]) / 2.0
+        distances = [
+            math.sqrt(((cx - other_x) ** 2) + ((cy - other_y) ** 2))
+            for other_x, other_y in zip((bucket[:, 0] + bucket[:, 2]) / 2.0, (bucket[:, 1] + bucket[:, 3]) / 2.0)
+            if int(other_x) != int(cx) and int(other_y) != int(cy)
+        ]
+        groups.append( (bucket, extract_frequency(distances, min_count=2)) )
+    return groups
+
+def is_tower_group(frequencies):
+    # We expect only 2 for features we want
+    return 0 < len(frequencies) <= 4
+
+def detect_towers(image, min_length=MIN_LINE_LENGTH_PX, tower_min_px=TOWER_LINE_MIN_PX, tower_max_px=TOWER_LINE_MAX_PX, debug=False, debug_scale=DEBUG_SCALE):
+    """
+    Finds lines of towers in image (HxWx3 BGR, as from cv2.imread). Returns (towers, composite): an (N, 4) int32 array of
+    the x1, y1, x2, y2 segment of every tower whose lines are between tower_min_px and tower_max_px long, and with debug a debug_scale sized image of every stage side by side, else None.
+    """
+    import cv2
+    thresh = otsu_threshold(to_gray(image, bgr=True))
+    lines, contours, polygons = contour_lines(thresh, min_length=min_length)
+    # We now re-do the same analysis on melded lines, which combines tiny fragments which overlap on x,y endpoints.
+    melded = meld_lines(lines, image.shape)
+    melded_lines, melded_contours, melded_polygons = contour_lines(melded, min_length=min_length)
+    isolated = isolated_lines(melded_lines)
+    groups = tower_line_groups(isolated, tower_min_px=tower_min_px, tower_max_px=tower_max_px)
+    towers = [bucket for bucket, frequencies in groups if is_tower_group(frequencies)]
+    towers = numpy.concatenate(towers) if len(towers) > 0 else numpy.zeros((0, 4), dtype=numpy.int32)
+    if not debug:
+        return towers, None
+
+    def small(img):
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        h, w = img.shape[:2]
+        return cv2.resize(img, (max(1, int(w * debug_scale)), max(1, int(h * debug_scale))), interpolation=cv2.INTER_AREA)
+    def scaled(points):
+        return [numpy.round(numpy.asarray(p) * debug_scale).astype(numpy.int32) for p in points]
+    def draw_lines(img, lines, color, thickness=1):
+        for x1, y1, x2, y2 in scaled(lines):
+            cv2.line(img, (int(x1), int(y1)), (int(x2), int(y2)), color, thickness)
+        return img
+
+    contours_image = small(image)
+    cv2.drawContours(contours_image, scaled(contours), -1, (0, 255, 0), 1)
+    cv2.drawContours(contours_image, scaled(polygons), -1, (0, 255, 255), 1)
+    draw_lines(contours_image, lines, (0, 0, 255)) # Red lines
+    melded_contours_image = small(melded)
+    cv2.drawContours(melded_contours_image, scaled(melded_contours), -1, (0, 255, 0), 1)
+    cv2.drawContours(melded_contours_image, scaled(melded_polygons), -1, (0, 255, 255), 1)
+    draw_lines(melded_contours_image, melded_lines, (0, 0, 255))
+    found_image = small(image)
+    for bucket, frequencies in groups:
+        group_color = (random.randint(50, 250), random.randint(50, 250), random.randint(50, 250))
+        draw_lines(found_image, bucket, (255, 255, 255), 3)
+        draw_lines(found_image, bucket, group_color, 2)
+    draw_lines(found_image, towers, (0, 0, 255)) # bgr red indicates a hit
+    composite = numpy.concatenate((
+        small(image),
+        small(thresh),
+        contours_image,
+        small(melded),
+        melded_contours_image,
+        draw_lines(small(image), isolated, (0, 0, 255)),
+        found_image,
+    ), axis=1)
+    return towers, composite
+
+def get_results_cache():
+    global results_cache
+    if results_cache is None:
+        results_cache = diskcache.Cache(RESULTS_CACHE_DIR)
+    return results_cache
+
+def image_key(image, min_length, tower_min_px, tower_max_px):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr( (image.shape, min_length, tower_min_px, tower_max_px, LINE_SIMILARITY_THRESHOLD) ).encode('utf-8'))
+    h.update(numpy.ascontiguousarray(image).data)
+    return f'towers-{h.hexdigest()}'
+
+def cached_detect_towers(image, min_length=MIN_LINE_LENGTH_PX, tower_min_px=TOWER_LINE_MIN_PX, tower_max_px=TOWER_LINE_MAX_PX, use_cache=True, debug=False):
+    """
+    detect_towers, re-using the towers found in an identical image before. A debug composite is never cached,
+    so debug always runs the detection.
+    """
+    detect_kwargs = dict(min_length=min_length, tower_min_px=tower_min_px, tower_max_px=tower_max_px)
+    if not use_cache:
+        return detect_towers(image, debug=debug, **detect_kwargs)
+    key = image_key(image, min_length, tower_min_px, tower_max_px)
+    cache = get_results_cache()
+    if not debug and not 'tower_detections' in os.environ.get('IGNORE_CACHES', ''):
+        towers = cache.get(key, None)
+        if towers is not None:
+            return towers, None
+    towers, composite = detect_towers(image, debug=debug, **detect_kwargs)
+    cache.set(key, towers, expire=RESULTS_CACHE_EXPIRE_S)
+    return towers, composite
+
+def detect_file(job):
+    """
+    Runs cached_detect_towers on the image file at path; writes the debug composite to debug_folder if one is given.
+    Returns (path, towers), towers is None when the file cannot be read.
+    """
+    import cv2
+    path, use_cache, debug_folder = job
+    image = cv2.imread(path)
+    if image is None:
+        return path, None
+    towers, composite = cached_detect_towers(image, use_cache=use_cache, debug=debug_folder is not None)
+    if composite is not None:
+        out_jpg = os.path.join(debug_folder, f'{os.path.splitext(os.path.basename(path))[0]}.debug.jpg')
+        cv2.imwrite(out_jpg, composite)
+        print(f'Output {out_jpg}')
+    return path, towers
+
+def detect_folder(folder, processes=None, use_cache=True, debug_folder=None):
+    """
+    Runs detect_file over every image in folder on a pool of processes, yielding (path, towers) as images finish.
+    """
+    paths = sorted(
+        os.path.join(folder, name) for name in os.listdir(folder) if name.casefold().endswith(IMAGE_EXTENSIONS)
+    )
+    if debug_folder is not None:
+        os.makedirs(debug_folder, exist_ok=True)
+    jobs = [ (path, use_cache, debug_folder) for path in paths ]
+    with multiprocessing.get_context('spawn').Pool(processes) as pool:
+        yield from pool.imap_unordered(detect_file, jobs, chunksize=4)
@@ -2,26 +2,159 @@
 # Designed to be imported by world-current.py
 import os
 import sys
+import csv
 import math
 import traceback
+import collections
+import multiprocessing
+import concurrent.futures
 
 import numpy
 import PIL
+import PIL.Image
+import PIL.ImageDraw
 
 import so_funcs
 import location_chipper
+import tile_store
+import projection
+import inference
+import chip_buffer
 
-# Measured in GIMP using image at zoom level 18 at -110.307589, 31.5964 (Tri-bar satellite calibration target at Fort Huachuca)
-measured_bar_lengths_px = (401.2 + 398.7 + 408.6) / 3.0
-PIXEL_WIDTH_METERS = 152.4 / measured_bar_lengths_px
-# print(f'At zoom {ZOOM} level each pixel is {round(pixel_width_meters, 3)} meters wide')
+# Positions closer than this to an already processed one are considered the same tower
+DEFAULT_VISITED_RADIUS_M = 10.0
+# Detections closer than this to an already registered tower are merged into it
+DEFAULT_TOWER_MERGE_RADIUS_M = 15.0
+# Tower ids of follow worker k start at (k + 1) * this so ids stay unique when the workers' towers are merged
+WORKER_TOWER_ID_STRIDE = 1000000
 
-def have_processed(list_of_xy, lonx, laty):
-    equality_epsilon = 0.0001
-    for x,y in list_of_xy:
-        if abs(x - lonx) < equality_epsilon and abs(y - laty) < equality_epsilon:
-            return True
-    return False
+# Predictive stepping: transmission lines run nearly straight with regular spans (the same spacing
+# run-tower-detections.py's extract_frequency measures in pixels), so once two towers of a line are known the
+# next one is looked for only in a small window one span further along the line's bearing.
+# Spans outside this range are treated as mis-detections and fall back to a full chip.
+MIN_PREDICTED_SPAN_M = 40.0
+MAX_PREDICTED_SPAN_M = 1200.0
+# Half-size of the window around the predicted tower, as a fraction of the span along and across the line
+PREDICTION_WINDOW_ALONG = 0.35
+PREDICTION_WINDOW_ACROSS = 0.25
+# A detection further than this fraction of the span from the predicted position is a miss
+PREDICTION_TOLERANCE = 0.35
+# Number of previous towers whose spans and bearings are averaged
+PREDICTION_HISTORY = 3
+# Consecutive spans bending more than this (degrees) are not treated as one straight line
+LINE_MAX_BEND_DEG = 20.0
+
+# Tiles for the next batch of frontier positions are downloaded here while the model scores the current batch
+prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='follow-prefetch')
+
+class VisitedIndex:
+    """
+    Set of processed follower positions with O(1) "was anything within radius_m already processed" lookups.
+    One instance may be shared by every facility followed in a run so lines reached from two facilities are only followed once.
+    """
+    def __init__(self, radius_m=DEFAULT_VISITED_RADIUS_M):
+        self.radius_m = radius_m
+        self.grid = so_funcs.GeoGrid(radius_m)
+
+    def __len__(self):
+        return len(self.grid)
+
+    def contains(self, lonx, laty):
+        return len(self.grid.nearby(lonx, laty, self.radius_m)) > 0
+
+    def add(self, lonx, laty):
+        self.grid.add(lonx, laty)
+
+class TowerRegistry:
+    """
+    Every tower found in a run, deduplicated in world space. Overlapping chips see the same tower several times at
+    slightly different positions; a detection within merge_radius_m of a registered tower is merged into it
+    (keeping the position and label of the most confident detection) instead of becoming a new tower.
+    Towers are dicts with a stable 'id' in order of first detection. Towers merged in from follow workers' registries
+    list the worker ids they were labeled with in their PNGs under 'aliases'.
+    """
+    CSV_FIELDS = ['id', 'lonx', 'laty', 'label', 'conf', 'detections', 'facility', 'depth', 'aliases']
+
+    def __init__(self, merge_radius_m=DEFAULT_TOWER_MERGE_RADIUS_M, first_id=0):
+        self.merge_radius_m = merge_radius_m
+        self.first_id = first_id
+        # Holds the position each tower was first registered at; merged positions stay within merge_radius_m of it
+        self.grid = so_funcs.GeoGrid(merge_radius_m)
+        self.towers = []
+        self.ids = dict() # tower id or alias -> index in towers
+
+    def __len__(self):
+        return len(self.towers)
+
+    def add(self, lonx, laty, label, conf, facility=None, depth=None, tower_id=None):
+        """
+        Registers one detection, returning (tower, True) if it is a new tower or (tower, False) if it was merged into an existing one.
+        A new tower gets the next id unless tower_id is given.
+        """
+        nearby = self.grid.nearby(lonx, laty, self.merge_radius_m)
+        if len(nearby) > 0:
+            tower = self.towers[nearby[0][3]]
+            tower['detections'] += 1
+            if conf > tower['conf']:
+                tower.update(lonx=lonx, laty=laty, label=label, conf=conf)
+            return tower, False
+        tower = {
+            'id': self.first_id + len(self.towers) if tower_id is None else tower_id, 'lonx': lonx, 'laty': laty, 'label': label, 'conf': conf,
+            'detections': 1, 'facility': facility, 'depth': depth, 'aliases': [],
+        }
+        self.ids[tower['id']] = len(self.towers)
+        self.grid.add(lonx, laty, len(self.towers))
+        self.towers.append(tower)
+        return tower, True
+
+    def add_boxes(self, boxes, box_lonxs_latys, facility=None, depth=None):
+        """
+        Registers every box of one chip, most confident first so two boxes on one tower merge into the better one.
+        Returns a list of (tower, is_new) in the same order as boxes.
+        """
+        added = [None] * len(boxes)
+        for k in sorted(range(len(boxes)), key=lambda k: -boxes[k][2]):
+            label, xyxy, conf = boxes[k]
+            box_lonx, box_laty = box_lonxs_latys[k]
+            added[k] = self.add(box_lonx, box_laty, label, conf, facility=facility, depth=depth)
+        return added
+
+    def merge(self, towers):
+        """
+        Adds towers (dicts from another TowerRegistry, with detections counting only those not merged before) keeping their ids.
+        Ones near a known tower are merged into it and their id is kept as an alias, so a tower merged again later lands
+        in the same place. Returns the merged tower of each of towers.
+        """
+        merged = []
+        for other in towers:
+            if other['id'] in self.ids:
+                tower = self.towers[self.ids[other['id']]]
+                tower['detections'] += other['detections']
+                if other['conf'] > tower['conf']:
+                    tower.update(lonx=other['lonx'], laty=other['laty'], label=other['label'], conf=other['conf'])
+            else:
+                tower, is_new = self.add(
+                    other['lonx'], other['laty'], other['label'], other['conf'],
+                    facility=other['facility'], depth=other['depth'], tower_id=other['id']
+                )
+                tower['detections'] += other['detections'] - 1
+                if not is_new:
+                    self.ids[other['id']] = self.ids[tower['id']]
+                    tower['aliases'].append(other['id'])
+            merged.append(tower)
+        return merged
+
+    def write_csv(self, out_csv, facility=None, towers=None):
+        """
+        Writes every tower (or only those first found from facility, or only towers) to out_csv.
+        """
+        with open(out_csv, 'w', newline='') as fd:
+            writer = csv.DictWriter(fd, fieldnames=self.CSV_FIELDS)
+            writer.writeheader()
+            for tower in self.towers if towers is None else towers:
+                if towers is not None or facility is None or tower['facility'] == facility:
+                    writer.writerow(dict(tower, aliases=' '.join(str(alias) for alias in tower['aliases'])))
+        print(f'Output {out_csv}')
 
 def next_nonexisting(directory, file_name_creator):
     n = 0
@@ -29,67 +162,61 @@ def next_nonexisting(directory, file_name_creator):
         n += 1
     return os.path.join(directory, file_name_creator(n))
 
-# i == number from gen fac, j == number in recursive sequence, primarially used for debugging
-def follow_towers(config, i, j, i_folder, lonx, laty, already_processed_xys, yolo_model, font, MAP_W_PX, MAP_H_PX, m_zoom):
-    if have_processed(already_processed_xys, lonx, laty) or j > 50 or len(already_processed_xys) > 50:
-        return 0
-    
-    #tower_following_out_png = os.path.join(i_folder, f'{j}.png')
-    tower_following_out_png = next_nonexisting(i_folder, lambda n:  f'{n}.png')
-    print(f'Writing tower-following results to {tower_following_out_png}')
-    print(f'Calling get_area_chip_image({lonx}, {laty})')
+def wait_for_prefetch(future):
+    # Prefetching is only an optimization, a failed download is retried when the chip is actually needed
+    if future is None:
+        return
     try:
-        pil_image = location_chipper.get_area_chip_image(
-            lonx, laty
-        )
+        future.result()
     except:
         traceback.print_exc()
-        return 0
-    
-    labeled_image = pil_image.copy()
+
+def geo_box_centers(chip_geo, boxes):
+    """
+    Returns the (lonx, laty) of each box's center in the chip described by chip_geo (a projection.ChipGeo).
+    """
+    if len(boxes) < 1:
+        return []
+    return [ (float(box_lonx), float(box_laty)) for box_lonx, box_laty in chip_geo.boxes_to_lonlat([xyxy for label, xyxy, conf in boxes]) ]
+
+def area_chip_geo(lonx, laty, pixels):
+    """
+    Describes the tile aligned chip location_chipper builds around lonx, laty.
+    """
+    tile_x, tile_y = location_chipper.latlon_to_tile(laty, lonx, location_chipper.ZOOM)
+    return projection.ChipGeo.centered_on_tile(tile_x, tile_y, location_chipper.ZOOM, tile_count=pixels.shape[0] // projection.TILE_SIZE)
+
+def label_chip(pixels, chip_geo, lonx, laty, boxes, box_lonxs_latys, font, tower_following_out_png, tower_ids=None):
+    """
+    Draws every box onto a copy of the chip's pixels, marks lonx, laty and saves it.
+    Boxes are numbered by their tower_ids when given.
+    """
+    labeled_image = PIL.Image.fromarray(pixels)
     drawable = PIL.ImageDraw.Draw(labeled_image)
 
     so_funcs.draw_text_with_border(
         drawable, (4.0, 4.0),
-        f'Image x,y center = {lonx}, {laty}\n',
+        f'Marker x,y = {lonx}, {laty}\n',
         font,
         '#ffffff',
     )
-    d_width, d_height = labeled_image.size
-    center_x = d_width // 2
-    center_y = d_height // 2
-    drawable.rectangle((center_x-2, center_y-2, center_x+4, center_y+4), fill=(255, 0, 0))
-    
-    numpy_image = numpy.array(pil_image)
-    numpy_images = [numpy_image]
-    image_results = list(yolo_model( numpy_images ))
-    if len(image_results) < 1:
-        print(f'At {i}/{j} model found no boxes!')
-        return 0
-    
-    image_result = image_results[0]
-    for tower_j, box in enumerate(image_result.boxes):
-        cls = int(box.cls[0])  # class index
-        label = yolo_model.names[cls]  # class name
-        xyxy = box.xyxy[0].tolist()  # bounding box coordinates
-        conf = float(box.conf[0])  # confidence score
+    marker_x, marker_y = (int(v) for v in chip_geo.lonlat_to_pixels(lonx, laty))
+    drawable.rectangle((marker_x-2, marker_y-2, marker_x+4, marker_y+4), fill=(255, 0, 0))
 
+    if tower_ids is None:
+        tower_ids = list(range(len(boxes)))
+    for tower_j, ((label, xyxy, conf), (box_gis_lonx, box_gis_laty), tower_id) in enumerate(zip(boxes, box_lonxs_latys, tower_ids)):
         box_pixels_center = so_funcs.center_of_bbox(*xyxy)
-        north_pixels_from_center = box_pixels_center[1] - center_y # laty
-        east_pixels_from_center = box_pixels_center[0] - center_x # lonx
-        # negative b/c latitude is the opposite direction of screen coordinates
-        box_gis_center = so_funcs.add_pixels_to_coordinates(laty, lonx, -north_pixels_from_center, east_pixels_from_center)
-
         so_funcs.draw_text_with_border(
             drawable, box_pixels_center,
-            f'<{tower_j}',
+            f'<{tower_id}',
             font,
             '#ffffff',
         )
 
         so_funcs.draw_text_with_border(
-            drawable, (5, (j * 30) + 50),
-            f'{tower_j} {box_pixels_center} is a {label} ({round(conf, 2)})\nat GIS location lonx,laty={round(box_gis_center[1], 4)},{round(box_gis_center[0], 4)}',
+            drawable, (5, (tower_j * 30) + 50),
+            f'{tower_id} {box_pixels_center} is a {label} ({round(conf, 2)})\nat GIS location lonx,laty={round(box_gis_lonx, 4)},{round(box_gis_laty, 4)}',
             font,
             '#ffffff',
         )
@@ -97,25 +224,372 @@ def follow_towers(config, i, j, i_folder, lonx, laty, already_processed_xys, yol
     labeled_image.save(tower_following_out_png)
     print(f'Output {tower_following_out_png}')
 
-    already_processed_xys.append( (lonx, laty) )
-    num_towers_processed = len(image_result.boxes)
+def predict_next_tower(history, lonx, laty):
+    """
+    Given the towers leading up to the one at lonx, laty, returns (predicted lonx, predicted laty, bearing, span_m)
+    of the next tower along the line, or None if there is not enough history or it does not look like a line.
+    """
+    if not history:
+        return None
+    path = list(history[-(PREDICTION_HISTORY - 1):]) + [ (lonx, laty) ]
+    if len(path) < 2:
+        return None
+    spans = [so_funcs.haversine_m(*path[k], *path[k+1]) for k in range(len(path) - 1)]
+    bearings = [math.radians(so_funcs.bearing_deg(*path[k], *path[k+1])) for k in range(len(path) - 1)]
+    span_m = sum(spans) / len(spans)
+    if not MIN_PREDICTED_SPAN_M <= span_m <= MAX_PREDICTED_SPAN_M:
+        return None
+    bearing = math.degrees(math.atan2(
+        sum(math.sin(b) for b in bearings), sum(math.cos(b) for b in bearings)
+    )) % 360.0
+    pred_lonx, pred_laty = so_funcs.destination_point(lonx, laty, bearing, span_m)
+    return pred_lonx, pred_laty, bearing, span_m
 
-    # And recurse through each tower until we run out of towers!
-    for tower_j, box in enumerate(image_result.boxes):
-        cls = int(box.cls[0])  # class index
-        label = yolo_model.names[cls]  # class name
-        xyxy = box.xyxy[0].tolist()  # bounding box coordinates
-        conf = float(box.conf[0])  # confidence score
-        
-        box_pixels_center = so_funcs.center_of_bbox(*xyxy)
-        north_pixels_from_center = box_pixels_center[1] - center_y # laty
-        east_pixels_from_center = box_pixels_center[0] - center_x # lonx
-        # negative b/c latitude is the opposite direction of screen coordinates
-        box_gis_laty, box_gis_lonx = so_funcs.add_pixels_to_coordinates(laty, lonx, -north_pixels_from_center, east_pixels_from_center)
-
-        num_towers_processed += follow_towers(
-            config, i, j+num_towers_processed+1, i_folder, box_gis_lonx, box_gis_laty, already_processed_xys,
-            yolo_model, font, MAP_W_PX, MAP_H_PX, m_zoom
+def bearing_difference_deg(a, b):
+    return abs((a - b + 180.0) % 360.0 - 180.0)
+
+def line_history(tower, known):
+    """
+    Returns the towers of known (oldest first, as (lonx, laty)) leading up to tower along a straight line, found by stepping to
+    the nearest tower a predictable span away which continues the line. These are the actual tower spacing and bearing,
+    unlike the positions the follower stepped through. Empty when no tower of known is within a predictable span.
+    """
+    chain = [ (tower['lonx'], tower['laty']) ]
+    candidates = [(other['lonx'], other['laty']) for other in known if other is not tower]
+    line_bearing = None
+    while len(chain) < PREDICTION_HISTORY:
+        best = None
+        for candidate in candidates:
+            if candidate in chain:
+                continue
+            span_m = so_funcs.haversine_m(*chain[-1], *candidate)
+            if not MIN_PREDICTED_SPAN_M <= span_m <= MAX_PREDICTED_SPAN_M:
+                continue
+            candidate_bearing = so_funcs.bearing_deg(*chain[-1], *candidate)
+            if line_bearing is not None and bearing_difference_deg(candidate_bearing, line_bearing) > LINE_MAX_BEND_DEG:
+                continue
+            if best is None or span_m < best[0]:
+                best = (span_m, candidate, candidate_bearing)
+        if best is None:
+            break
+        span_m, candidate, line_bearing = best
+        chain.append(candidate)
+    return tuple(reversed(chain[1:]))
+
+def line_item(tower, history, depth, scanned_geo):
+    """
+    Returns the frontier item continuing from tower: one predicting the next tower along history (the towers leading up to
+    tower), None if that next tower lies well inside scanned_geo (the chip or window which found tower already looked there,
+    eg tower is between two known towers of the line), or one for a full chip when there is no line to predict along.
+    """
+    prediction = predict_next_tower(history, tower['lonx'], tower['laty'])
+    if prediction is None:
+        return (tower['lonx'], tower['laty'], depth, None, False)
+    pred_lonx, pred_laty, bearing, span_m = prediction
+    pred_x, pred_y = scanned_geo.lonlat_to_pixels(pred_lonx, pred_laty)
+    margin_px = PREDICTION_TOLERANCE * span_m / scanned_geo.meters_per_pixel()
+    if margin_px <= pred_x <= scanned_geo.width_px - margin_px and margin_px <= pred_y <= scanned_geo.height_px - margin_px:
+        return None
+    return (tower['lonx'], tower['laty'], depth, tuple(history), True)
+
+def prediction_window_tiles(pred_lonx, pred_laty, bearing, span_m, zoom):
+    """
+    Returns (min tile x, min tile y, max tile x, max tile y) covering a rectangle around the predicted tower
+    which is oriented along bearing.
+    """
+    tile_xs = []
+    tile_ys = []
+    for along in (-PREDICTION_WINDOW_ALONG, PREDICTION_WINDOW_ALONG):
+        for across in (-PREDICTION_WINDOW_ACROSS, PREDICTION_WINDOW_ACROSS):
+            c_lonx, c_laty = so_funcs.destination_point(pred_lonx, pred_laty, bearing, along * span_m)
+            c_lonx, c_laty = so_funcs.destination_point(c_lonx, c_laty, bearing + 90.0, across * span_m)
+            tile_x, tile_y = location_chipper.latlon_to_tile(c_laty, c_lonx, zoom)
+            tile_xs.append(tile_x)
+            tile_ys.append(tile_y)
+    return min(tile_xs), min(tile_ys), max(tile_xs), max(tile_ys)
+
+def stitch_window(window_tiles):
+    try:
+        return location_chipper.stitch_tile_range_array(*window_tiles, location_chipper.ZOOM)
+    except:
+        traceback.print_exc()
+        return None
+
+def recenter_mosaic(mosaic, lonx, laty):
+    """
+    Returns the mosaic's SharedChip (or pixels) after scrolling it to lonx, laty, or None if that failed.
+    """
+    try:
+        pixels = mosaic.recenter_lonx_laty(lonx, laty)
+        return pixels if mosaic.chip is None else mosaic.chip
+    except:
+        traceback.print_exc()
+        return None
+
+def assign_mosaics(mosaics, lonxs_latys, max_mosaics):
+    """
+    Picks a different mosaic for each (lonx, laty), preferring the one which needs the fewest new tiles to move there.
+    New mosaics are only added to the mosaics list once every existing one is taken, up to max_mosaics.
+    """
+    free = list(mosaics)
+    assigned = []
+    for lonx, laty in lonxs_latys:
+        center_x, center_y = location_chipper.latlon_to_tile(laty, lonx, location_chipper.ZOOM)
+        best = min(free, key=lambda m: m.num_new_tiles(center_x, center_y), default=None)
+        if (best is None or best.num_new_tiles(center_x, center_y) >= best.tile_count ** 2) and len(mosaics) < max_mosaics:
+            size = location_chipper.TILE_SIZE * 11
+            best = location_chipper.ScrollingMosaic(chip=chip_buffer.SharedChip((size, size, 3)))
+            mosaics.append(best)
+        else:
+            free.remove(best)
+        assigned.append(best)
+    return assigned
+
+# i == number from gen fac, j == depth of the starting position, primarially used for debugging
+# visited is a VisitedIndex, possibly shared with other calls
+# chip may be passed when the caller already has the chip centered at lonx, laty (a chip_buffer.SharedChip, numpy array or PIL image)
+# towers is a TowerRegistry, possibly shared with other calls
+def follow_towers(config, i, j, i_folder, lonx, laty, visited, yolo_model, font, MAP_W_PX, MAP_H_PX, m_zoom, chip=None, towers=None):
+    """
+    Follows towers breadth-first out from lonx, laty. Every pending tower position is kept in a frontier; up to
+    follow_batch_size positions at a time have their imagery fetched concurrently and are scored by yolo_model as one batch,
+    and every tower found that is not already in towers becomes a new frontier position. Returns the number of new towers found.
+
+    A position normally gets a full chip around it. With follow_predictive enabled, a new tower at the end of a straight
+    line of towers first only gets a small window where the next tower is predicted to be (using the spacing and bearing of
+    the towers before it), and a full chip only if that misses. New towers whose next tower would lie inside the chip that
+    found them (eg between two known towers of a line) are not followed further, that chip already covered it.
+    """
+    batch_size = int(config.get('follow_batch_size', 8))
+    if batch_size < 1:
+        raise ValueError(f'follow_batch_size must be at least 1, got {batch_size}')
+    max_depth = int(config.get('follow_max_depth', 50))
+    max_positions = int(config.get('follow_max_positions', 50))
+    predictive = bool(config.get('follow_predictive', False))
+    detect_kwargs = inference.config_detect_kwargs(config)
+    if towers is None:
+        towers = TowerRegistry(float(config.get('follow_tower_merge_radius_m', DEFAULT_TOWER_MERGE_RADIUS_M)))
+
+    # Frontier items are (lonx, laty, depth, towers leading up to this one or None, whether prediction may be tried).
+    # The starting position is a facility rather than a tower, so it has no history and always gets a full chip.
+    frontier = collections.deque([ (lonx, laty, j, None, False) ])
+    # Positions whose prediction missed; they were already counted as visited and get a full chip next batch
+    fallbacks = collections.deque()
+    known_chips = dict()
+    if chip is not None:
+        known_chips[(lonx, laty)] = chip if isinstance(chip, (chip_buffer.SharedChip, numpy.ndarray)) else numpy.asarray(chip)
+    # Consecutive positions along a line are a tower span apart, so their chips mostly overlap; each batch item
+    # scrolls whichever of these mosaics is closest instead of stitching a whole new chip.
+    # Mosaics live in shared memory so chips reach the model (or the inference daemon) without being copied.
+    mosaics = []
+    try:
+        num_towers_processed = 0
+        num_positions = 0
+        next_batch_prefetch = None
+
+        while (len(frontier) > 0 and num_positions < max_positions) or len(fallbacks) > 0:
+            batch = []
+            while len(fallbacks) > 0 and len(batch) < batch_size:
+                batch.append(fallbacks.popleft())
+            while len(frontier) > 0 and len(batch) < batch_size and num_positions < max_positions:
+                item = frontier.popleft()
+                b_lonx, b_laty, b_depth = item[:3]
+                if b_depth > max_depth or visited.contains(b_lonx, b_laty):
+                    continue
+                # Marked as soon as it is scheduled so duplicates still waiting in the frontier are skipped
+                visited.add(b_lonx, b_laty)
+                num_positions += 1
+                batch.append(item)
+            if len(batch) < 1:
+                continue
+
+            predicted = []
+            full = []
+            for item in batch:
+                b_lonx, b_laty, b_depth, b_history, b_may_predict = item
+                prediction = predict_next_tower(b_history, b_lonx, b_laty) if predictive and b_may_predict else None
+                if prediction is None:
+                    full.append(item)
+                else:
+                    predicted.append( (item, prediction) )
+
+            # While this batch downloads and runs through the model, start downloading the tiles the next batch will need
+            wait_for_prefetch(next_batch_prefetch)
+            next_batch_prefetch = prefetch_pool.submit(
+                location_chipper.prefetch_area_chips, [item[:2] for item in list(frontier)[:batch_size] if not predictive or not item[3]]
+            )
+
+            if len(predicted) > 0:
+                windows_tiles = [prediction_window_tiles(*prediction, location_chipper.ZOOM) for item, prediction in predicted]
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(predicted)) as pool:
+                    windows = list(pool.map(stitch_window, windows_tiles))
+                scored = [k for k, window in enumerate(windows) if window is not None]
+                window_detections = inference.detect(yolo_model, [windows[k] for k in scored], **detect_kwargs)
+                window_detections = dict(zip(scored, window_detections))
+
+                for k, ((item, prediction), window_tiles, window) in enumerate(zip(predicted, windows_tiles, windows)):
+                    b_lonx, b_laty, b_depth, b_history, b_may_predict = item
+                    pred_lonx, pred_laty, bearing, span_m = prediction
+                    boxes = inference.detection_boxes(yolo_model, window_detections[k]) if k in window_detections else []
+                    window_geo = projection.ChipGeo.from_tile_range(*window_tiles, location_chipper.ZOOM)
+                    window_box_lonxs_latys = geo_box_centers(window_geo, boxes)
+                    hits = [
+                        (so_funcs.haversine_m(pred_lonx, pred_laty, box_lonx, box_laty), hit_k)
+                        for hit_k, (box_lonx, box_laty) in enumerate(window_box_lonxs_latys)
+                    ]
+                    hits = [(distance_m, hit_k) for distance_m, hit_k in hits if distance_m <= PREDICTION_TOLERANCE * span_m]
+                    if len(hits) < 1:
+                        print(f'At {i}/{b_depth} predicted tower at {pred_lonx}, {pred_laty} was not found, falling back to a full chip')
+                        fallbacks.append( (b_lonx, b_laty, b_depth, b_history, False) )
+                        continue
+
+                    added = towers.add_boxes(boxes, window_box_lonxs_latys, facility=i, depth=b_depth + 1)
+                    tower_following_out_png = next_nonexisting(i_folder, lambda n:  f'{n}.png')
+                    print(f'Writing predicted tower-following results to {tower_following_out_png}')
+                    label_chip(
+                        window, window_geo, pred_lonx, pred_laty, boxes, window_box_lonxs_latys, font, tower_following_out_png,
+                        tower_ids=[tower['id'] for tower, is_new in added]
+                    )
+                    tile_store.tiles.boost(
+                        location_chipper.TILE_LAYER, location_chipper.ZOOM,
+                        [(x, y) for y in range(window_tiles[1], window_tiles[3] + 1) for x in range(window_tiles[0], window_tiles[2] + 1)],
+                        tile_store.FOLLOW_PATH_BOOST_S
+                    )
+                    # Only the hit continues the line; other new towers in the window may start a branching or parallel line,
+                    # which gets a full chip. A hit seen before was reached from elsewhere already, which also continued the line from there.
+                    hit_tower = added[min(hits)[1]][0]
+                    for tower, is_new in added:
+                        if not is_new:
+                            continue
+                        num_towers_processed += 1
+                        if tower is hit_tower:
+                            child = line_item(tower, (b_history + ((b_lonx, b_laty),))[-PREDICTION_HISTORY:], b_depth + 1, window_geo)
+                        else:
+                            child = (tower['lonx'], tower['laty'], b_depth + 1, None, False)
+                        if child is not None:
+                            frontier.append(child)
+
+            if len(full) < 1:
+                continue
+
+            images = [known_chips.pop(item[:2], None) for item in full]
+            to_fetch = [idx for idx, image in enumerate(images) if image is None]
+            if len(to_fetch) > 0:
+                fetch_lonxs_latys = [full[idx][:2] for idx in to_fetch]
+                for b_lonx, b_laty in fetch_lonxs_latys:
+                    print(f'Scrolling mosaic to ({b_lonx}, {b_laty})')
+                fetch_mosaics = assign_mosaics(mosaics, fetch_lonxs_latys, batch_size)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(to_fetch)) as pool:
+                    futures = [pool.submit(recenter_mosaic, mosaic, b_lonx, b_laty) for mosaic, (b_lonx, b_laty) in zip(fetch_mosaics, fetch_lonxs_latys)]
+                    for idx, future in zip(to_fetch, futures):
+                        images[idx] = future.result()
+
+            full = [item for item, image in zip(full, images) if image is not None]
+            images = [image for image in images if image is not None]
+            if len(images) < 1:
+                continue
+            for item in full:
+                location_chipper.boost_area_chip(item[0], item[1], tile_store.FOLLOW_PATH_BOOST_S)
+
+            image_detections = inference.detect(yolo_model, images, **detect_kwargs)
+
+            for (b_lonx, b_laty, b_depth, b_history, b_may_predict), image, detections in zip(full, images, image_detections):
+                image = numpy.asarray(image)
+                tower_following_out_png = next_nonexisting(i_folder, lambda n:  f'{n}.png')
+                print(f'Writing tower-following results to {tower_following_out_png}')
+                boxes = inference.detection_boxes(yolo_model, detections)
+                if len(boxes) < 1:
+                    print(f'At {i}/{b_depth} model found no boxes!')
+                # The chip is tile aligned, so b_lonx, b_laty is somewhere in its center tile rather than at its center pixel
+                chip_geo = area_chip_geo(b_lonx, b_laty, image)
+                chip_box_lonxs_latys = geo_box_centers(chip_geo, boxes)
+                added = towers.add_boxes(boxes, chip_box_lonxs_latys, facility=i, depth=b_depth + 1)
+                label_chip(
+                    image, chip_geo, b_lonx, b_laty, boxes, chip_box_lonxs_latys, font, tower_following_out_png,
+                    tower_ids=[tower['id'] for tower, is_new in added]
+                )
+
+                # And queue each new tower until we run out of towers! Towers seen before were queued when first found.
+                known = [tower for tower, is_new in added]
+                for tower, is_new in added:
+                    if not is_new:
+                        continue
+                    num_towers_processed += 1
+                    if predictive:
+                        child = line_item(tower, line_history(tower, known), b_depth + 1, chip_geo)
+                    else:
+                        child = (tower['lonx'], tower['laty'], b_depth + 1, None, False)
+                    if child is not None:
+                        frontier.append(child)
+
+        wait_for_prefetch(next_batch_prefetch)
+        return num_towers_processed
+    finally:
+        for mosaic in mosaics:
+            mosaic.chip.free()
+
+# State of a follow worker process, set up once by init_follow_worker
+worker_state = dict()
+
+def init_follow_worker(config, path_to_tower_model_file, processes, worker_ids):
+    with worker_ids.get_lock():
+        worker_k = worker_ids.value
+        worker_ids.value += 1
+    tile_store.configure_from_config(config)
+    # Split the cores between the workers instead of every worker's model using all of them ("0" means all cores too)
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    config = dict(config)
+    if int(config.get('inference_threads', 0)) == 0:
+        config['inference_threads'] = threads
+    worker_state['config'] = config
+    try:
+        if config.get('inference_backend', 'ultralytics') == 'ultralytics' and not config.get('inference_daemon', False):
+            import torch
+            torch.set_num_threads(int(config['inference_threads']))
+        worker_state['yolo_model'] = inference.load_model(path_to_tower_model_file, config)
+    except Exception as e:
+        # Raising here would make the pool restart the worker forever; every job reports it instead
+        traceback.print_exc()
+        worker_state['error'] = f'{type(e).__name__}: {e}'
+    worker_state['font'] = so_funcs.get_default_ttf_font(18)
+    worker_state['visited'] = VisitedIndex(float(config.get('follow_visited_radius_m', DEFAULT_VISITED_RADIUS_M)))
+    worker_state['towers'] = TowerRegistry(
+        float(config.get('follow_tower_merge_radius_m', DEFAULT_TOWER_MERGE_RADIUS_M)), first_id=(worker_k + 1) * WORKER_TOWER_ID_STRIDE
+    )
+
+def follow_facility_in_worker(job):
+    """
+    Follows one facility in a worker process. Returns (i, every tower it detected) for the parent to merge,
+    with detections counting only this facility's detections.
+    """
+    if 'error' in worker_state:
+        raise RuntimeError(f'Follow worker could not load the tower model: {worker_state["error"]}')
+    i, i_folder, lonx, laty, m_zoom = job
+    towers = worker_state['towers']
+    detections_before = [tower['detections'] for tower in towers.towers]
+    try:
+        pixels = location_chipper.get_area_chip_array(lonx, laty)
+        follow_towers(
+            worker_state['config'], i, 0, i_folder, lonx, laty, worker_state['visited'], worker_state['yolo_model'], worker_state['font'],
+            pixels.shape[1], pixels.shape[0], m_zoom, chip=pixels, towers=towers
         )
+    except:
+        traceback.print_exc()
+    detected = []
+    for k, tower in enumerate(towers.towers):
+        before = detections_before[k] if k < len(detections_before) else 0
+        if tower['detections'] > before:
+            detected.append(dict(tower, detections=tower['detections'] - before))
+    return i, detected
 
-    return num_towers_processed
+def follow_facilities_in_processes(config, path_to_tower_model_file, jobs, processes):
+    """
+    Follows every (i, i_folder, lonx, laty, m_zoom) in jobs on a pool of processes, each with its own model (or a connection to
+    the inference daemon) and its own visited positions and towers. Yields (i, towers detected from facility i) as
+    facilities finish; pass them to TowerRegistry.merge.
+    """
+    context = multiprocessing.get_context('spawn')
+    worker_ids = context.Value('i', 0)
+    with context.Pool(processes, initializer=init_follow_worker, initargs=(config, path_to_tower_model_file, processes, worker_ids)) as pool:
+        # chunksize=1 makes every idle worker take the next facility, so a few long lines do not hold up the others
+        yield from pool.imap_unordered(follow_facility_in_worker, jobs, chunksize=1)
@@ -9,6 +9,7 @@
 #   "shapely",
 #   "requests",
 #   "ultralytics",
+#   "opencv-python",
 #   "numpy"
 # ]
 # ///
@@ -20,7 +21,6 @@ import time
 import random
 import json
 import math
-import threading
 import subprocess
 import webbrowser
 import shutil
@@ -37,14 +37,16 @@ import shapely.geometry
 import shapely.wkt
 
 import numpy
-import ultralytics
 
 sys.path.append(os.path.dirname(__file__))
 
 import so_funcs
+import gppd_index
+import tile_store
 import analytic_tile_server
 import location_chipper
 import tower_follower
+import inference
 
 cache = diskcache.Cache(platformdirs.user_cache_dir('world-current'))
 CACHE_EXPIRE_S = 60 * 60
@@ -128,6 +130,64 @@ path_to_global_power_plant_database = "./path/to/global_power_plant_database.csv
 
 # step1_map = '/tmp/step1-map.png'
 # step2_facility_chips_folder = '/tmp'
+
+# Render step1_map through a localhost analytic_tile_server instead of reading tiles in-process
+# step1_use_tile_server = false
+
+## performance tuning
+
+# Number of facility chips stitched at once; peak memory is roughly 2 * chip_workers * 24mb
+# These chips (and follow_batch_size mosaics per follow process) live in /dev/shm, so it needs roughly
+# (2 * chip_workers + follow_batch_size) * 24mb free. Docker gives only 64mb by default, run with eg --shm-size=1g;
+# chips that do not fit are kept in process memory instead, and the inference daemon then refuses them
+# chip_workers = 4
+
+# Tower following: chips scored per model call, how far and how many positions to follow from each facility,
+# and how close (in meters) a position must be to an already-followed one to be skipped
+# follow_batch_size = 8
+# follow_max_depth = 50
+# follow_max_positions = 50
+# follow_visited_radius_m = 10
+# Detections of the same tower from overlapping chips closer than this are merged into one tower
+# follow_tower_merge_radius_m = 15
+# Once two towers of a line are known, look for the next one only in a small window one span further along the line,
+# falling back to a full chip when nothing is found there
+# follow_predictive = false
+# Follow that many facilities at once in separate processes, each with its own copy of the model (or a connection to
+# the inference daemon) and its share of the CPU threads. Workers do not share visited positions, so a line reachable
+# from facilities handled by different workers may be followed by both; its towers are still merged into one, and the
+# worker ids it was labeled with are listed in towers.csv as aliases. Workers stitch their own facility chips, so with
+# step2_facility_chips_folder set (or no tower model yet) every facility chip is built twice.
+# follow_processes = 1
+
+# Run the tower model over overlapping windows of its training size (imgsz=1694) instead of shrinking whole chips to it;
+# finds more small towers for about 4x the model work per chip
+# inference_sliced = false
+# inference_slice_overlap = 0.2
+# "ultralytics" runs the .pt model in PyTorch; "onnxruntime" or "openvino" export it to ONNX next to the .pt once
+# (or ahead of time with `uv run onnx_backend.py model.pt`) and run that on the CPU with inference_threads threads (0 = all cores),
+# optionally quantized to INT8 (slightly different boxes, faster). Both are optional installs, eg
+# `uv run --with onnx --with onnxruntime world-current.py config.toml` (or `--with openvino`).
+# inference_backend = "ultralytics"
+# inference_threads = 0
+# inference_int8 = false
+# Re-use detections of chips whose pixels, model file and inference settings are unchanged (IGNORE_CACHES=detections skips it)
+# inference_cache = true
+# Score chips in inference_daemon.py, which keeps models loaded between runs and batches chips from concurrent runs;
+# it is started on first use and listens on a Unix socket under the user cache dir
+# inference_daemon = false
+# Skip the model for chips with fewer than this many short, thin, straight dark regions per megapixel (open desert, water,
+# dense forest); 0 runs the model on every chip, 0.4 (about 3 per 2816x2816 chip) skips most empty rural chips
+# inference_prefilter = 0
+
+# Imagery tiles are kept under the user cache dir up to this many gb, least-recently-used tiles are evicted first
+# (tiles around facilities and along followed lines are kept longer). Inspect with `uv run tile_store.py stats`.
+# imagery_cache_max_gb = 20
+# Days a tile is re-used before being downloaded again, per zoom level; unlisted zooms use 7 days, z15+ default to 90
+# imagery_cache_zoom_ttl_days = {{ 18 = 90 }}
+# Also store every tile's decoded pixels next to it, which skips decoding tiles again in later runs but takes ~10x the
+# space of the JPEG, so the same imagery_cache_max_gb holds ~10x fewer tiles
+# imagery_cache_decoded = false
 ```
 
 '''.strip())
@@ -152,6 +212,8 @@ if __name__ == '__main__':
   print('=' * 18, ' CONFIG ', '=' * 18)
   print(f'{toml.dumps(config)}')
 
+  tile_store.configure_from_config(config)
+
   # Step 1: Read region into a list of polygons.
   polygons, bbox = so_funcs.load_geometries(config['region'])
   b_minx, b_miny, b_maxx, b_maxy = bbox
@@ -161,11 +223,14 @@ if __name__ == '__main__':
 
   # Step 2: Read path_to_global_power_plant_database and filter to list of generating facilities within region.
   path_to_global_power_plant_database = config['path_to_global_power_plant_database']
-  global_power_plants_list = so_funcs.cvs2dicts(path_to_global_power_plant_database)
-  region_power_plants = [
-    p for p in global_power_plants_list if 'latitude' in p and 'longitude' in p and b_minx <= float(p['longitude']) <= b_maxx and b_miny <= float(p['latitude']) <= b_maxy
-  ]
-  print(f'Given {len(global_power_plants_list):,} power plants recorded globally, {len(region_power_plants):,} fall within selected region')
+  global_power_plants = gppd_index.load(path_to_global_power_plant_database)
+  # The index narrows plants down to the region's bounding box, then only those truly within a region polygon are kept
+  bbox_plant_indices = global_power_plants.query_bbox(b_minx, b_miny, b_maxx, b_maxy)
+  in_region = so_funcs.points_in_polygons(
+    polygons, global_power_plants.lonx[bbox_plant_indices], global_power_plants.laty[bbox_plant_indices]
+  )
+  region_power_plants = global_power_plants.rows(bbox_plant_indices[in_region])
+  print(f'Given {len(global_power_plants):,} power plants recorded globally, {len(region_power_plants):,} fall within selected region')
   #print(f'region_power_plants = {json.dumps(region_power_plants, indent=2)}')
 
   m_zoom = so_funcs.calculate_zoom(*bbox, MAP_W_PX, MAP_H_PX) # we use this in several locations, so generate it once
@@ -175,11 +240,15 @@ if __name__ == '__main__':
   if step1_map_png_path is not None and len(step1_map_png_path) > 0 and os.path.exists(os.path.dirname(step1_map_png_path)):
     print(f'Outputting step1 map to {step1_map_png_path}')
 
-    port = random.randint(8000, 8200)
-    t = analytic_tile_server.spawn_run_thread(cache, port)
-    time.sleep(0.1)
+    step1_use_tile_server = config.get('step1_use_tile_server', False)
+    if step1_use_tile_server:
+      port = random.randint(8000, 8200)
+      t = analytic_tile_server.spawn_run_thread(port)
+      time.sleep(0.1)
+      m = staticmap.StaticMap(MAP_W_PX, MAP_H_PX, url_template=f'http://127.0.0.1:{port}/tile/{{z}}/{{y}}/{{x}}.png')
+    else:
+      m = analytic_tile_server.InProcessStaticMap(MAP_W_PX, MAP_H_PX)
 
-    m = staticmap.StaticMap(MAP_W_PX, MAP_H_PX, url_template=f'http://127.0.0.1:{port}/tile/{{z}}/{{y}}/{{x}}.png')
     for p in region_power_plants:
       marker = staticmap.CircleMarker(
         (so_funcs.get_lonx_from_dict(p), so_funcs.get_laty_from_dict(p) ),
@@ -217,7 +286,8 @@ if __name__ == '__main__':
 
     image_m.save(step1_map_png_path)
 
-    analytic_tile_server.shutdown()
+    if step1_use_tile_server:
+      analytic_tile_server.shutdown()
 
   else:
     print(f'Did not find a key step1_map in config, skipping map preview')
@@ -225,28 +295,23 @@ if __name__ == '__main__':
 
   font = so_funcs.get_default_ttf_font(16)
 
-  power_plant_images = [None for p in region_power_plants]
-
-  def render_one(i, p):
-    image = location_chipper.get_area_chip_image(
-      so_funcs.get_lonx_from_dict(p), so_funcs.get_laty_from_dict(p)
-    )
-    power_plant_images[i] = image
+  # Nearby facilities share most of their z18 tiles; download the union of every chip's tiles once up-front
+  # so the per-facility chips below are all assembled from cache.
+  region_lonxs_latys = [(so_funcs.get_lonx_from_dict(p), so_funcs.get_laty_from_dict(p)) for p in region_power_plants]
+  num_unique_tiles, num_downloaded_tiles = location_chipper.prefetch_area_chips(region_lonxs_latys, boost_s=tile_store.FACILITY_BOOST_S)
+  print(f'{len(region_power_plants):,} facility chips need {num_unique_tiles:,} unique tiles, downloaded {num_downloaded_tiles:,} missing tiles')
 
-  threads = []
-  for i, p in enumerate(region_power_plants):
-    t = threading.Thread(target=render_one, args=(i, p))
-    t.start()
-    threads.append(t)
-  for t in threads:
-    t.join()
+  # Chips are ~24mb each, so rather than holding one per facility we stitch at most chip_workers at a time
+  # and hand each one to every consumer below, in shared memory (chip_buffer.SharedChip), as soon as it is finished.
+  chip_workers = int(config.get('chip_workers', 4))
+  chip_consumers = []
 
   step2_facility_chips_folder = config.get('step2_facility_chips_folder', None)
   if not step2_facility_chips_folder is None and os.path.exists(os.path.dirname(step2_facility_chips_folder)):
     os.makedirs(step2_facility_chips_folder, exist_ok=True)
-    for i, image in enumerate(power_plant_images):
+    def write_step2_chip(i, chip):
       out_png = os.path.join(step2_facility_chips_folder, f'{i}.png')
-      labeled_image = image.copy()
+      labeled_image = PIL.Image.fromarray(chip.pixels)
       drawable = PIL.ImageDraw.Draw(labeled_image)
       so_funcs.draw_text_with_border(
         drawable, (2, 2),
@@ -256,12 +321,11 @@ if __name__ == '__main__':
       )
       labeled_image.save(out_png)
       print(f'Output {out_png}')
+    chip_consumers.append(write_step2_chip)
   else:
     print(f'Did not find a key step2_facility_chips_folder in config, skipping chips preview')
   print()
 
-  print(f'We now have {len(power_plant_images):,} images matching to our {len(region_power_plants):,} facilities')
-
   path_to_tower_model_file = config.get('path_to_tower_model_file', None)
   if path_to_tower_model_file is not None and not os.path.exists(path_to_tower_model_file):
     path_to_tower_model_file = None
@@ -270,16 +334,94 @@ if __name__ == '__main__':
     print(f'Either no path_to_tower_model_file key specified or the file does not exist; we are placing chips')
     print(f'at {training_images_folder} and templating out a training environment.')
     os.makedirs(training_images_folder, exist_ok=True)
-    for i, image in enumerate(power_plant_images):
+    def write_training_image(i, chip):
       out_png = os.path.join(training_images_folder, f'{i}.png')
       if os.path.exists(out_png):
         age_s = time.time() - os.path.getmtime(out_png)
         if age_s < 30 * 50:
           print(f'We already have output {out_png} {int(age_s)} seconds ago, skipping')
-          continue
-      image.save(out_png)
+          return
+      PIL.Image.fromarray(chip.pixels).save(out_png)
       print(f'Output {out_png}')
+    chip_consumers.append(write_training_image)
 
+  step3_tower_following_folder = config.get('step3_tower_following_folder', None)
+  report_html_fragments = dict()
+
+  def facility_folder(i):
+    i_folder = os.path.join(step3_tower_following_folder, f'{i}')
+    if os.path.exists(i_folder):
+      shutil.rmtree(i_folder, ignore_errors=True)
+    os.makedirs(i_folder, exist_ok=True)
+    return i_folder
+
+  def add_facility_report(i, i_folder, facility_towers=None):
+    towers.write_csv(os.path.join(i_folder, 'towers.csv'), facility=i, towers=facility_towers)
+    p_as_json = json.dumps(region_power_plants[i], indent=4, sort_keys=True)
+    report_html = f'<details><summary><h2 style="margin-top:0;">Facility {i}<h2></summary><pre>{p_as_json}</pre></details>'
+    report_html += '<div style="display:inline;overflow-x:scroll;max-width:98vw;">'
+    for image_name in sorted(os.listdir(i_folder)):
+      if image_name.casefold().endswith('.png') or image_name.casefold().endswith('.jpg'):
+        report_html += f'<img src="{i}/{image_name}" width=512 height=512/>'
+    report_html += '</div>'
+    report_html += '<hr/>'
+    report_html_fragments[i] = report_html
+
+  def follow_facility(i, chip):
+    i_folder = facility_folder(i)
+    p = region_power_plants[i]
+    p_lonx, p_laty = (so_funcs.get_lonx_from_dict(p), so_funcs.get_laty_from_dict(p))
+
+    tower_follower.follow_towers(
+      config, i, 0, i_folder, p_lonx, p_laty, visited, yolo_model, step3_font,
+      chip.shape[1], chip.shape[0], m_zoom, chip=chip, towers=towers
+    )
+    add_facility_report(i, i_folder)
+
+  def follow_facilities_in_processes():
+    # Each worker loads its own model and keeps its own visited positions; the parent merges their towers
+    jobs = []
+    for i, (p_lonx, p_laty) in enumerate(region_lonxs_latys):
+      jobs.append( (i, facility_folder(i), p_lonx, p_laty, m_zoom) )
+    print(f'Following towers from {len(jobs):,} facilities in {follow_processes} processes')
+    for i, i_towers in tower_follower.follow_facilities_in_processes(config, path_to_tower_model_file, jobs, follow_processes):
+      # Worker ids of towers merged into another tower are kept as its aliases, so PNG labels can be looked up in towers.csv
+      add_facility_report(i, os.path.join(step3_tower_following_folder, f'{i}'), facility_towers=towers.merge(i_towers))
+
+  def load_tower_model():
+    print(f'Loading {path_to_tower_model_file} and using it to find tower positions in imagery...')
+    return inference.load_model(path_to_tower_model_file, config)
+
+  yolo_model = None
+  step3_font = so_funcs.get_default_ttf_font(18)
+  # Shared by every facility so a line reachable from several facilities is only followed once
+  visited = tower_follower.VisitedIndex(float(config.get('follow_visited_radius_m', tower_follower.DEFAULT_VISITED_RADIUS_M)))
+  towers = tower_follower.TowerRegistry(float(config.get('follow_tower_merge_radius_m', tower_follower.DEFAULT_TOWER_MERGE_RADIUS_M)))
+  follow_processes = int(config.get('follow_processes', 1))
+  if path_to_tower_model_file is not None and not step3_tower_following_folder is None and follow_processes < 2:
+    yolo_model = load_tower_model()
+    chip_consumers.append(follow_facility)
+
+  def stream_facility_chips(consumers):
+    num_chips = 0
+    for i, chip in location_chipper.iter_area_chips(region_lonxs_latys, workers=chip_workers):
+      if chip is None:
+        continue
+      try:
+        for consumer in consumers:
+          consumer(i, chip)
+      finally:
+        chip.release()
+      num_chips += 1
+    return num_chips
+
+  if len(chip_consumers) > 0:
+    num_chips = stream_facility_chips(chip_consumers)
+    print(f'We processed {num_chips:,} images matching to our {len(region_power_plants):,} facilities')
+  if path_to_tower_model_file is not None and not step3_tower_following_folder is None and follow_processes > 1:
+    follow_facilities_in_processes()
+
+  if path_to_tower_model_file is None:
     cmd = ['uv', 'run', os.path.join(os.path.dirname(__file__), 'run-labeler.py'), training_images_folder]
     print(f'> {" ".join(cmd)}')
     subprocess.run(cmd, check=True)
@@ -293,41 +435,22 @@ if __name__ == '__main__':
       print(f'Please go set path_to_tower_model_file to the .pt file we just created in your {config_file}!')
       sys.exit(1)
 
+    if not step3_tower_following_folder is None and follow_processes > 1:
+      follow_facilities_in_processes()
+    elif not step3_tower_following_folder is None:
+      yolo_model = load_tower_model()
+      stream_facility_chips([follow_facility])
 
-  print(f'Loading {path_to_tower_model_file} and using it to find tower positions in imagery...')
-
-  yolo_model = ultralytics.YOLO(path_to_tower_model_file)
-
-  step3_tower_following_folder = config.get('step3_tower_following_folder', None)
   if not step3_tower_following_folder is None:
-    font = so_funcs.get_default_ttf_font(18)
     report_html_path = os.path.join(step3_tower_following_folder, 'index.html')
+    towers_csv_path = os.path.join(step3_tower_following_folder, 'towers.csv')
+    towers.write_csv(towers_csv_path)
     report_html = '<html><head><title>Following Results</title></head><body>'
-    for i, p in enumerate( region_power_plants ):
-      i_folder = os.path.join(step3_tower_following_folder, f'{i}')
-      if os.path.exists(i_folder):
-        shutil.rmtree(i_folder, ignore_errors=True)
-      os.makedirs(i_folder, exist_ok=True)
-      p = region_power_plants[i]
-      p_lonx, p_laty = (so_funcs.get_lonx_from_dict(p), so_funcs.get_laty_from_dict(p))
-
-      tower_follower.follow_towers(
-        config, i, 0, i_folder, p_lonx, p_laty, list(), yolo_model, font,
-        image.width, image.height, m_zoom
-      )
-
-
-      p_as_json = json.dumps(region_power_plants[i], indent=4, sort_keys=True)
-      report_html += f'<details><summary><h2 style="margin-top:0;">Facility {i}<h2></summary><pre>{p_as_json}</pre></details>'
-      report_html += '<div style="display:inline;overflow-x:scroll;max-width:98vw;">'
-      for image_name in sorted(os.listdir(i_folder)):
-        if image_name.casefold().endswith('.png') or image_name.casefold().endswith('.jpg'):
-          report_html += f'<img src="{i}/{image_name}" width=512 height=512/>'
-      report_html += '</div>'
-      report_html += '<hr/>'
-
+    report_html += f'<p>Found {len(towers):,} towers, see <a href="towers.csv">towers.csv</a></p><hr/>'
+    for i in sorted(report_html_fragments.keys()):
+      report_html += report_html_fragments[i]
     report_html += '</body>'
-    
+
     with open(report_html_path, 'w') as fd:
       fd.write(report_html)
     webbrowser.open(report_html_path)